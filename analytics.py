@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Co-participation analytics of charters and actors.
+
+The cypher query 'E5Events connected via a common E39Actor'
+
+    MATCH p=(n:E5Event)-[]-(:E39Actor)-[]-(:E5Event) RETURN p
+
+enumerates every path between every pair of charters and doesn't scale to a whole archive. The same information is
+contained in the charter x actor incidence matrix A of the P11_had_participant relationships:
+
+ - A . A^T is the charter x charter matrix of the number of actors two charters have in common
+ - A^T . A is the actor x actor matrix of the number of charters two actors appear in together
+
+Both are computed as sparse matrix products with scipy. The incidence matrix is built from the graph or straight from
+the extraction output and cached on disk. New and changed charters are added as a block D of changed rows, and the
+co-occurrence matrices are updated without recomputing them: (A + D)(A + D)^T = A A^T + A D^T + D A^T + D D^T.
+
+The content hash and pipeline version of every charter are kept with the matrices. Charters are read from the graph
+again whenever their version in the graph differs, e.g. after they were re-ingested, or after their statements were
+retracted, in which case their actors are removed from the matrices.
+
+Actors like 'St. Katharinenspital' take part in almost every charter. Queries can ignore actors which appear in more
+than max_share of the charters, otherwise every charter is a neighbour of every other one.
+
+Usage:
+
+    $ python analytics.py --update-from-graph --charter 'SpAR Urk. 35' -k 10
+
+See: https://docs.scipy.org/doc/scipy/reference/sparse.html
+"""
+from __future__ import unicode_literals
+from graph_writer import (charter_statements, relationship_type)
+from neomodel import db
+from scipy import sparse
+import argparse
+import json
+import numpy
+import os
+
+
+class CoParticipation:
+
+    def __init__(self):
+        # charter index -> charter id, actor index -> actor name and the reverse lookups
+        self.charters = []
+        self.actors = []
+        self._charter_index = {}
+        self._actor_index = {}
+        # charter x actor incidence matrix
+        self._incidence = sparse.csr_matrix((0, 0), dtype=numpy.int32)
+        # co-occurrence matrices, computed on first use and then kept up to date
+        self._charter_cooccurrence = None
+        self._actor_cooccurrence = None
+        # charter index -> actor indices of charters added since the last update
+        self._pending = {}
+        # charter id -> (content hash, pipeline version) of the added charters
+        self.versions = {}
+
+    def add(self, charter_id, actors, version=(None, None)):
+        """
+        Set the actors of a charter. The actors of a charter that was added before are replaced.
+
+        :param charter_id: the charter id used by the archive
+        :param actors: names of the actors of the charter
+        :param version: content hash and pipeline version of the charter, see GraphWriter.filter_changed
+        :return:
+        """
+        self._pending[self._index(self.charters, self._charter_index, charter_id)] = set(
+            self._index(self.actors, self._actor_index, actor) for actor in actors)
+        self.versions[charter_id] = tuple(version)
+
+    def add_extraction(self, charter_id, dep_data, version=(None, None)):
+        """
+        Set the actors of a charter from the triple or quadruple returned by NLP.analyze_dep
+
+        :param charter_id: the charter id used by the archive
+        :param dep_data: the triple or quadruple
+        :param version: content hash and pipeline version of the charter
+        :return:
+        """
+        _, relationships = charter_statements(charter_id, dep_data)
+        self.add(charter_id, [dst[1] for src, prop, dst in relationships
+                              if src[0] == "E5Event" and prop == "P11_had_participant"], version)
+
+    def load_graph(self, batch_size=10000):
+        """
+        Read the charters which are new in the graph or whose version in the graph has changed since they were
+        added. Charters which were deleted from the graph lose their actors.
+
+        :param batch_size: number of charters read per query
+        :return: the number of charters read
+        """
+        rel_type, _ = relationship_type("E5Event", "P11_had_participant")
+        read = 0
+        seen = set()
+        after = -1
+        while True:
+            # only the versions are compared, the actors are read for the changed charters only
+            rows, _ = db.cypher_query("MATCH (c:E5Event) WHERE id(c) > $after AND NOT c:E7Activity "
+                                      "WITH c ORDER BY id(c) LIMIT $limit "
+                                      "RETURN id(c), c.name, c.content_hash, c.pipeline_version",
+                                      {'after': after, 'limit': batch_size})
+            if not rows:
+                break
+            versions = {}
+            for node_id, charter_id, content_hash, pipeline_version in rows:
+                seen.add(charter_id)
+                if self.versions.get(charter_id) != (content_hash, pipeline_version):
+                    versions[charter_id] = (content_hash, pipeline_version)
+                after = node_id
+            if versions:
+                actor_rows, _ = db.cypher_query("MATCH (c:E5Event) WHERE c.name IN $ids AND NOT c:E7Activity "
+                                                "OPTIONAL MATCH (c)-[:{0}]-(a:E39Actor) "
+                                                "RETURN c.name, collect(a.name)".format(rel_type),
+                                                {'ids': list(versions)})
+                for charter_id, actors in actor_rows:
+                    self.add(charter_id, actors, versions[charter_id])
+                read += len(actor_rows)
+        for charter_id in self.charters:
+            if charter_id not in seen and self.versions.get(charter_id) is not None:
+                self.add(charter_id, [])
+                del self.versions[charter_id]
+        return read
+
+    def update(self):
+        """
+        Apply the charters added since the last update to the incidence matrix and the co-occurrence matrices
+
+        :return:
+        """
+        if not self._pending:
+            return
+        shape = (len(self.charters), len(self.actors))
+        incidence = _resize(self._incidence, shape)
+        rows = sorted(self._pending)
+        entries = [(row, column) for row in rows for column in self._pending[row]]
+        new = sparse.csr_matrix((numpy.ones(len(entries), dtype=numpy.int32),
+                                 ([row for row, _ in entries], [column for _, column in entries])), shape=shape)
+        selected = sparse.csr_matrix((numpy.ones(len(rows), dtype=numpy.int32), (rows, rows)),
+                                     shape=(shape[0], shape[0]))
+        # the block of changed rows: new rows minus the rows they replace
+        delta = (new - selected.dot(incidence)).tocsr()
+        delta.eliminate_zeros()
+        if self._charter_cooccurrence is not None:
+            self._charter_cooccurrence = (_resize(self._charter_cooccurrence, (shape[0], shape[0])) +
+                                          incidence.dot(delta.T) + delta.dot(incidence.T) + delta.dot(delta.T)).tocsr()
+            self._charter_cooccurrence.eliminate_zeros()
+        if self._actor_cooccurrence is not None:
+            self._actor_cooccurrence = (_resize(self._actor_cooccurrence, (shape[1], shape[1])) +
+                                        incidence.T.dot(delta) + delta.T.dot(incidence) + delta.T.dot(delta)).tocsr()
+            self._actor_cooccurrence.eliminate_zeros()
+        self._incidence = (incidence + delta).tocsr()
+        self._incidence.eliminate_zeros()
+        self._pending = {}
+
+    @property
+    def incidence(self):
+        """
+        The charter x actor incidence matrix
+        """
+        self.update()
+        return self._incidence
+
+    def charter_cooccurrence(self):
+        """
+        :return: the charter x charter matrix of the number of common actors
+        """
+        self.update()
+        if self._charter_cooccurrence is None:
+            self._charter_cooccurrence = self._incidence.dot(self._incidence.T).tocsr()
+        return self._charter_cooccurrence
+
+    def actor_cooccurrence(self):
+        """
+        :return: the actor x actor matrix of the number of common charters
+        """
+        self.update()
+        if self._actor_cooccurrence is None:
+            self._actor_cooccurrence = self._incidence.T.dot(self._incidence).tocsr()
+        return self._actor_cooccurrence
+
+    def charter_neighbours(self, charter_id, k=10, max_share=None):
+        """
+        Return the charters which have the most actors in common with a charter
+
+        :param charter_id: the charter id
+        :param k: number of neighbours
+        :param max_share: ignore actors which appear in more than this share of the charters, e.g. 0.1
+        :return: list of (charter id, number of common actors) tuples
+        """
+        row = self._charter_index[charter_id]
+        incidence = self.incidence
+        if max_share is None and self._charter_cooccurrence is not None:
+            counts = self._charter_cooccurrence[row]
+        else:
+            # a single row of A . A^T, the whole matrix is dense if some actors appear in most charters
+            if max_share is not None:
+                incidence = incidence.dot(self._common_actors(max_share))
+            counts = incidence[row].dot(incidence.T)
+        return self._top(counts, row, k, self.charters)
+
+    def actor_neighbours(self, actor, k=10):
+        """
+        Return the actors which appear together with an actor in the most charters
+
+        :param actor: the actor name
+        :param k: number of neighbours
+        :return: list of (actor name, number of common charters) tuples
+        """
+        row = self._actor_index[actor]
+        return self._top(self.actor_cooccurrence()[row], row, k, self.actors)
+
+    def save(self, directory):
+        """
+        Save the matrices and the index to a directory
+
+        :param directory: the cache directory
+        :return:
+        """
+        self.update()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        matrices = {'incidence': self._incidence, 'charter_cooccurrence': self._charter_cooccurrence,
+                    'actor_cooccurrence': self._actor_cooccurrence}
+        for name, matrix in matrices.items():
+            path = os.path.join(directory, name + '.npz')
+            if matrix is not None:
+                sparse.save_npz(path, matrix)
+            elif os.path.exists(path):
+                os.remove(path)
+        # the index is replaced last and atomically, it refers to the matrices written before
+        with open(os.path.join(directory, 'index.json.tmp'), 'w') as index_file:
+            json.dump({'charters': self.charters, 'actors': self.actors, 'versions': self.versions}, index_file)
+        os.rename(os.path.join(directory, 'index.json.tmp'), os.path.join(directory, 'index.json'))
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Load the matrices and the index saved in a directory
+
+        :param directory: the cache directory
+        :return: the CoParticipation, empty if nothing was saved yet
+        """
+        analytics = cls()
+        if not os.path.exists(os.path.join(directory, 'index.json')):
+            return analytics
+        with open(os.path.join(directory, 'index.json')) as index_file:
+            index = json.load(index_file)
+        analytics.charters = index['charters']
+        analytics.actors = index['actors']
+        # caches saved without versions are read from the graph again
+        analytics.versions = dict((charter_id, tuple(version))
+                                  for charter_id, version in index.get('versions', {}).items())
+        analytics._charter_index = dict((charter_id, i) for i, charter_id in enumerate(analytics.charters))
+        analytics._actor_index = dict((actor, i) for i, actor in enumerate(analytics.actors))
+        analytics._incidence = sparse.load_npz(os.path.join(directory, 'incidence.npz')).tocsr()
+        for name in ('charter_cooccurrence', 'actor_cooccurrence'):
+            path = os.path.join(directory, name + '.npz')
+            if os.path.exists(path):
+                setattr(analytics, '_' + name, sparse.load_npz(path).tocsr())
+        return analytics
+
+    def _common_actors(self, max_share):
+        # diagonal matrix selecting the actors which appear in at most max_share of the charters
+        shares = numpy.asarray((self._incidence > 0).sum(axis=0)).ravel() / float(max(len(self.charters), 1))
+        return sparse.diags((shares <= max_share).astype(numpy.int32), dtype=numpy.int32)
+
+    @staticmethod
+    def _top(counts, row, k, names):
+        counts = counts.tocsr() if sparse.issparse(counts) else sparse.csr_matrix(counts)
+        indices, values = counts.indices, counts.data
+        keep = (indices != row) & (values > 0)
+        indices, values = indices[keep], values[keep]
+        if len(values) > k:
+            best = numpy.argpartition(-values, k)[:k]
+            indices, values = indices[best], values[best]
+        order = numpy.lexsort((indices, -values))
+        return [(names[indices[i]], int(values[i])) for i in order]
+
+    @staticmethod
+    def _index(names, index, name):
+        if name not in index:
+            index[name] = len(names)
+            names.append(name)
+        return index[name]
+
+
+def _resize(matrix, shape):
+    # pad a sparse matrix with empty rows and columns
+    if matrix.shape == shape:
+        return matrix
+    matrix = matrix.tocoo()
+    return sparse.csr_matrix((matrix.data, (matrix.row, matrix.col)), shape=shape)
+
+
+if __name__ == "__main__":
+    from examples import config_file
+
+    parser = argparse.ArgumentParser(description='Co-participation of charters and actors.')
+    parser.add_argument('--update-from-graph', action='store_true', help='add the charters written or changed since '
+                                                                         'the last run')
+    parser.add_argument('--charter', help='show the charters with the most actors in common with this charter')
+    parser.add_argument('--actor', help='show the actors appearing together with this actor most often')
+    parser.add_argument('-k', type=int, default=10, help='number of neighbours')
+    parser.add_argument('--max-share', type=float, help='ignore actors appearing in more than this share of charters')
+    args = parser.parse_args()
+
+    cache = config_file['analytics']['cache']
+    analytics = CoParticipation.load(cache)
+    if args.update_from_graph:
+        print('{0} charters read from the graph'.format(analytics.load_graph()))
+    if args.charter:
+        for charter_id, common in analytics.charter_neighbours(args.charter, args.k, args.max_share):
+            print('{0}\t{1}'.format(common, charter_id))
+    if args.actor:
+        for actor, common in analytics.actor_neighbours(args.actor, args.k):
+            print('{0}\t{1}'.format(common, actor))
+    analytics.save(cache)
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+End-to-end benchmark of the ingestion pipeline.
+
+A synthetic corpus of German charter abstracts is generated from the templates of Katharinenspital's regesta and
+processed chunk by chunk. The stages are timed separately:
+
+ - parse: NLP.spacy_dependency_parse, one abstract at a time
+ - analyze: NLP.analyze_dep
+ - write: writing the extracted entities to the graph, either batched with the GraphWriter (to the in-process
+   MemoryStore, to an in-memory LocalGraph or to neo4j) or with connect_entities/create_crm_entity_with_name (neomodel,
+   one node and relation at a time, like do_nlp, against the backend set in config.json)
+
+For every stage docs/s, p50/p99 latency per doc and peak RSS are reported. The results can be saved as JSON and
+compared with the results of an earlier run, so regressions of a stage become visible before deployment.
+
+Usage:
+
+    $ python benchmark.py --size 10000 --graph memory --json results.json --baseline baseline.json
+"""
+from __future__ import unicode_literals
+from array import array
+from graph_writer import (GraphWriter, Neo4jStore)
+from local_graph import (LocalGraph, MemoryStore)
+from nlp import NLP
+import argparse
+import examples
+import json
+import random
+import resource
+import time
+
+FIRST_NAMES = ['Ulrich', 'Otto', 'Heinrich', 'Konrad', 'Bruno', 'Rudger', 'Hainreich', 'Albert', 'Ortlieb', 'Gerwin',
+               'Friedrich', 'Liebhart', 'Wernher', 'Chunrat', 'Perchtold', 'Dietrich']
+ORIGINS = ['Abbach', 'Aichkirchen', 'Trautenberch', 'Chesching', 'Paulstorf', 'Teingen', 'Sulzbach', 'Kelheim',
+           'Straubing', 'Landshut', 'Prüfening', 'Donaustauf']
+OCCUPATIONS = ['Mulnar', 'Schuster', 'Fleischhacker', 'Zimmermann', 'Richter', 'Bürger']
+PLACES = ['Regensburg', 'Teingen', 'Pfaffenriut', 'Chesching', 'Storenstain', 'Stadtamhof', 'Kumpfmühl', 'Prüll',
+          'Weichs', 'Wörth', 'Lappersdorf', 'Pentling']
+OBJECTS = [('sein', 'Gut'), ('seinen', 'Hof'), ('zwei', 'Höfe'), ('zwei', 'Äcker'), ('eine', 'Wiese'),
+           ('einen', 'Grund'), ('ein', 'Haus'), ('seinen', 'Zehent'), ('einen', 'Weingarten')]
+VERBS = ['verkauft', 'vermacht', 'verschafft', 'schenkt', 'verstiftet']
+SPITAL = ['dem Spital', 'dem St. Katharinenspital', 'dem Katharinenspital']
+TEMPLATES = [
+    '{name} von {origin} {verb} {spital} {det} {object} in {place} um {price} Pfennig.',
+    '{name} von {origin} {verb} {spital} {det} {object} zu {place}.',
+    '{name} von {origin} {verb} {spital} für {price} Pfund {det} {object} in der Stadt {place}.',
+    '{name} der {occupation} von {origin} {verb} {spital} {det} {object} zu {place} ({place2}).',
+    '{name} von {origin}, Richter zu {place}, {verb} {spital} {det} {object} zu {place2}.',
+]
+STAGES = ['parse', 'analyze', 'write']
+
+
+def synthetic_abstracts(size, seed=0):
+    """
+    Generate synthetic charter abstracts from the templates of the regesta
+
+    :param size: number of abstracts, e.g. 1000 to 1000000
+    :param seed: seed of the random generator, the same seed generates the same corpus
+    :return: generator of (charter abstract, charter id) tuples
+    """
+    rand = random.Random(seed)
+    for i in range(size):
+        det, obj = rand.choice(OBJECTS)
+        abstract = rand.choice(TEMPLATES).format(
+            name=rand.choice(FIRST_NAMES), origin=rand.choice(ORIGINS), occupation=rand.choice(OCCUPATIONS),
+            verb=rand.choice(VERBS), spital=rand.choice(SPITAL), det=det, object=obj, place=rand.choice(PLACES),
+            place2=rand.choice(PLACES), price=rand.randint(2, 120))
+        yield abstract, 'SYN Urk. {0}'.format(i + 1)
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the process (Linux only, elsewhere the peak of the whole run is reported)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss():
+    """
+    :return: the peak resident set size in MB since the last reset
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is given in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Stage:
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = array(str('d'))
+        self.elapsed = 0.0
+        self.peak_rss = 0.0
+
+    def run(self, function, items):
+        """
+        Apply a function to every item and record the latency per item
+
+        :param function: the function of the stage
+        :param items: the items of a chunk
+        :return: the results of the function
+        """
+        reset_peak_rss()
+        results = []
+        for item in items:
+            start = time.time()
+            results.append(function(item))
+            self.latencies.append(time.time() - start)
+        self.elapsed += sum(self.latencies[-len(items):]) if items else 0.0
+        self.peak_rss = max(self.peak_rss, peak_rss())
+        return results
+
+    def summary(self):
+        """
+        :return: dict with docs, docs/s, p50 and p99 latency in ms and peak RSS in MB
+        """
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {'docs': 0}
+        return {
+            'docs': len(latencies),
+            'docs_per_s': len(latencies) / self.elapsed if self.elapsed else 0.0,
+            'p50_ms': latencies[int(0.50 * (len(latencies) - 1))] * 1000,
+            'p99_ms': latencies[int(0.99 * (len(latencies) - 1))] * 1000,
+            'peak_rss_mb': self.peak_rss,
+        }
+
+
+def run(nlp, size, graph='memory', chunk_size=1000, seed=0):
+    """
+    Run the benchmark
+
+    :param nlp: the NLP pipeline
+    :param size: number of synthetic abstracts
+    :param graph: 'memory', 'local', 'neo4j', 'neomodel' or 'none'
+    :param chunk_size: number of abstracts processed stage by stage
+    :param seed: seed of the synthetic corpus
+    :return: dict of stage -> summary
+    """
+    stages = dict((name, Stage(name)) for name in STAGES)
+    writer = None
+    if graph in ('memory', 'local', 'neo4j'):
+        writer = GraphWriter({'memory': MemoryStore, 'local': LocalGraph, 'neo4j': Neo4jStore}[graph]())
+    elif graph == 'neomodel':
+        # preload the entities of earlier runs into the entity cache
+        examples.warm_up_entity_cache()
+
+    def write(item):
+        charter_id, dep_data = item
+        if writer is not None:
+            writer.add(charter_id, dep_data)
+        else:
+            charter = examples.models.E5Event(name=charter_id)
+            charter.save()
+            # connect_entities needs at least a subject and a verb
+            if len(dep_data) >= 2:
+                examples.connect_entities(charter, dep_data)
+
+    chunk = []
+    for item in synthetic_abstracts(size, seed):
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            _run_chunk(nlp, stages, chunk, write if graph != 'none' else None)
+            chunk = []
+    _run_chunk(nlp, stages, chunk, write if graph != 'none' else None)
+    if writer is not None:
+        start = time.time()
+        writer.flush()
+        stages['write'].elapsed += time.time() - start
+    return dict((name, stage.summary()) for name, stage in stages.items())
+
+
+def _run_chunk(nlp, stages, chunk, write):
+    if not chunk:
+        return
+    docs = stages['parse'].run(nlp.spacy_dependency_parse, [charter_abstract for charter_abstract, _ in chunk])
+    dep_data = stages['analyze'].run(nlp.analyze_dep, docs)
+    if write is not None:
+        stages['write'].run(write, [(charter_id, data) for (_, charter_id), data in zip(chunk, dep_data)])
+
+
+def report(results, baseline=None):
+    """
+    Format the results, compared with the results of an earlier run
+
+    :param results: dict of stage -> summary
+    :param baseline: optional results of an earlier run
+    :return: the report
+    """
+    lines = ['{0:<8} {1:>9} {2:>10} {3:>9} {4:>9} {5:>11}'.format('stage', 'docs', 'docs/s', 'p50 ms', 'p99 ms',
+                                                                  'peak RSS MB')]
+    for name in STAGES:
+        summary = results.get(name, {})
+        if not summary.get('docs'):
+            continue
+        line = '{0:<8} {1:>9} {2:>10.1f} {3:>9.3f} {4:>9.3f} {5:>11.1f}'.format(
+            name, summary['docs'], summary['docs_per_s'], summary['p50_ms'], summary['p99_ms'],
+            summary['peak_rss_mb'])
+        if baseline and baseline.get(name, {}).get('docs_per_s'):
+            change = summary['docs_per_s'] / baseline[name]['docs_per_s'] - 1
+            line += '  {0:+.1%} docs/s'.format(change)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the ingestion pipeline on a synthetic corpus.')
+    parser.add_argument('--size', type=int, default=1000, help='number of synthetic abstracts (1k to 1M)')
+    parser.add_argument('--graph', default='memory', choices=['memory', 'local', 'neo4j', 'neomodel', 'none'],
+                        help='graph store of the write stage')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='number of abstracts processed stage by stage')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic corpus')
+    parser.add_argument('--json', help='save the results to a JSON file')
+    parser.add_argument('--baseline', help='compare with the results of an earlier run')
+    args = parser.parse_args()
+
+    nlp = NLP(examples.config_file['spacy']['model'], examples.config_file['spacy']['components'],
+              aliases=examples.aliases)
+    results = run(nlp, args.size, args.graph, args.chunk_size, args.seed)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print(report(results, baseline))
+    print(nlp.report())
+    if args.graph == 'neomodel':
+        print('entity cache: {0} hits, {1} misses'.format(examples.entity_cache.hits, examples.entity_cache.misses))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Offline export of regesta graphs for neo4j-admin import.
+
+The first load of a whole archive doesn't need transactions: the CSVExportStore can be passed to the GraphWriter
+instead of the Neo4jStore and writes the nodes and relationships to CSV files in the format of neo4j's offline
+importer, one file per CRM class and per relationship type:
+
+    nodes_E21Person.csv                       :ID,name,...,:LABEL
+    relationships_P11i_participated_in.csv    :START_ID,:END_ID,:TYPE,charters:string[]
+
+The ids are derived from CRM class and name, so the same entity gets the same id in every export. The labels of a
+node are the labels of its CRM class and its super classes, like the ones the Neo4jStore sets. Nodes and
+relationships are deduplicated before they are written, because neo4j-admin import doesn't merge anything.
+
+Nodes are written as soon as they are seen the first time. Relationships are streamed to a run file per
+relationship type with every batch, so nothing but the ids of the written nodes is kept in memory. The same
+relationship may be extracted from charters of several batches, so the run files are sorted with the external sort
+command when the export is closed, and the rows of the same relationship are merged into one row with the charter
+ids of all of them.
+
+Values are quoted, so names may contain commas, quotes and line breaks (the import command allows multiline fields).
+Charter ids containing the array delimiter can't be exported, the batch with such a charter is rejected.
+
+Usage:
+
+    $ python ingest.py regesta/ --export export/
+    $ neo4j-admin import --nodes=export/nodes_E5Event.csv ... --relationships=export/relationships_...
+
+See: https://neo4j.com/docs/operations-manual/current/tools/neo4j-admin/neo4j-admin-import/
+"""
+from __future__ import unicode_literals
+from crm import models
+import hashlib
+import io
+import json
+import os
+import subprocess
+
+
+def node_id(label, name):
+    """
+    Return the stable id of a node
+
+    :param label: the crm class
+    :param name: the node name
+    :return: the id
+    """
+    return hashlib.sha1('{0}\t{1}'.format(label, name).encode('utf-8')).hexdigest()[:20]
+
+
+def quote(value):
+    """
+    Quote a CSV field for neo4j-admin import
+
+    :param value: the field value
+    :return: the quoted value, an empty string for missing values
+    """
+    if value is None:
+        return ''
+    return '"' + '{0}'.format(value).replace('"', '""') + '"'
+
+
+class CSVExportStore:
+
+    def __init__(self, directory, array_delimiter=';'):
+        """
+        :param directory: the export directory
+        :param array_delimiter: delimiter of labels and charter ids, the default of neo4j-admin import
+        """
+        self.directory = directory
+        self.array_delimiter = array_delimiter
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # remove the files of an earlier export, so they aren't imported by accident
+        for name in os.listdir(directory):
+            if name.endswith(('.csv', '.run', '.sorted')) and name.startswith(('nodes_', 'relationships_')):
+                os.remove(os.path.join(directory, name))
+        # ids of the written nodes
+        self._node_ids = set()
+        # crm class -> (node file, property columns, labels)
+        self._node_files = {}
+        # relationship type -> run file of unmerged relationship rows
+        self._run_files = {}
+        self.nodes_written = 0
+        self.relationships_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, nodes, relationships):
+        """
+        Add a batch of nodes and relationships to the export, see Neo4jStore.write
+
+        :param nodes: dict of crm class -> list of {'name': ..., 'props': {...}} rows
+        :param relationships: dict of (source crm class, relationship type, target crm class) -> list of
+            {'src': ..., 'dst': ..., 'charters': [...]} rows
+        :return:
+        """
+        # the charter ids are written as arrays, the importer would split ids containing the array delimiter.
+        # The batch is rejected before anything of it is written
+        for rows in relationships.values():
+            for row in rows:
+                for charter_id in row['charters']:
+                    if self.array_delimiter in charter_id:
+                        raise ValueError("charter id '{0}' contains the array delimiter '{1}'".format(
+                            charter_id, self.array_delimiter))
+        for label, rows in nodes.items():
+            node_file, columns, labels = self._node_file(label)
+            for row in rows:
+                id_ = node_id(label, row['name'])
+                if id_ in self._node_ids:
+                    continue
+                self._node_ids.add(id_)
+                props = dict(row['props'], name=row['name'])
+                node_file.write(','.join([quote(id_)] + [quote(props.get(column)) for column in columns] +
+                                         [quote(labels)]) + '\n')
+                self.nodes_written += 1
+        for (src_label, rel_type, dst_label), rows in relationships.items():
+            run_file = self._run_file(rel_type)
+            for row in rows:
+                # the ids have a fixed length, so the rows of a relationship are adjacent once the run is sorted
+                run_file.write('{0}\t{1}\t{2}\n'.format(node_id(src_label, row['src']), node_id(dst_label, row['dst']),
+                                                       json.dumps(sorted(row['charters']))))
+
+    def charter_state(self, charter_ids):
+        """
+        An export always starts from an empty graph
+
+        :param charter_ids: list of charter ids
+        :return: an empty dict
+        """
+        return {}
+
+    def retract(self, charter_ids):
+        """
+        Exported statements can't be retracted, the export has to be imported into an empty database
+
+        :param charter_ids: list of charter ids
+        :return:
+        """
+        raise ValueError("statements can't be retracted from an export")
+
+    def close(self):
+        """
+        Close the node files and merge the run files into the relationship files
+
+        :return:
+        """
+        for node_file, _, _ in self._node_files.values():
+            node_file.close()
+        for run_file in self._run_files.values():
+            run_file.close()
+        for rel_type in sorted(self._run_files):
+            self._merge_run(rel_type)
+        self._node_files = {}
+        self._run_files = {}
+
+    def import_command(self, database=None):
+        """
+        Return the neo4j-admin import command for the exported files
+
+        :param database: optional name of the database to import into
+        :return: the command
+        """
+        # quoted fields may contain line breaks, e.g. names taken from abstracts
+        command = ['neo4j-admin', 'import', "--array-delimiter='{0}'".format(self.array_delimiter),
+                   '--multiline-fields=true']
+        if database:
+            command.append('--database={0}'.format(database))
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith('nodes_') and name.endswith('.csv'):
+                command.append('--nodes={0}'.format(os.path.join(self.directory, name)))
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith('relationships_') and name.endswith('.csv'):
+                command.append('--relationships={0}'.format(os.path.join(self.directory, name)))
+        return ' '.join(command)
+
+    def _node_file(self, label):
+        if label not in self._node_files:
+            model = getattr(models, label)
+            columns = sorted(model.defined_properties(aliases=False, rels=False))
+            # the labels of the crm class and its super classes, like SET n:E21Person:E39Actor:... in Neo4jStore
+            labels = self.array_delimiter.join(model.inherited_labels())
+            header = ','.join([':ID'] + columns + [':LABEL'])
+            self._node_files[label] = (self._open('nodes_{0}.csv'.format(label), header), columns, labels)
+        return self._node_files[label]
+
+    def _run_file(self, rel_type):
+        if rel_type not in self._run_files:
+            self._run_files[rel_type] = io.open(self._run_path(rel_type), 'w', encoding='utf-8')
+        return self._run_files[rel_type]
+
+    def _run_path(self, rel_type):
+        return os.path.join(self.directory, 'relationships_{0}.run'.format(rel_type))
+
+    def _merge_run(self, rel_type):
+        run_path = self._run_path(rel_type)
+        sorted_path = run_path[:-len('.run')] + '.sorted'
+        # sort by byte values, the run may be larger than the memory
+        subprocess.check_call(['sort', '-o', sorted_path, run_path], env=dict(os.environ, LC_ALL='C'))
+        os.remove(run_path)
+        rel_file = self._open('relationships_{0}.csv'.format(rel_type), ':START_ID,:END_ID,:TYPE,charters:string[]')
+        try:
+            with io.open(sorted_path, encoding='utf-8') as sorted_file:
+                ends, charter_ids = None, set()
+                for line in sorted_file:
+                    src, dst, charters = line.rstrip('\n').split('\t')
+                    if (src, dst) != ends:
+                        if ends is not None:
+                            self._write_relationship(rel_file, ends, rel_type, charter_ids)
+                        ends, charter_ids = (src, dst), set()
+                    charter_ids.update(json.loads(charters))
+                if ends is not None:
+                    self._write_relationship(rel_file, ends, rel_type, charter_ids)
+        finally:
+            rel_file.close()
+        os.remove(sorted_path)
+
+    def _write_relationship(self, rel_file, ends, rel_type, charter_ids):
+        src, dst = ends
+        rel_file.write(','.join([quote(src), quote(dst), quote(rel_type),
+                                 quote(self.array_delimiter.join(sorted(charter_ids)))]) + '\n')
+        self.relationships_written += 1
+
+    def _open(self, name, header):
+        export_file = io.open(os.path.join(self.directory, name), 'w', encoding='utf-8')
+        export_file.write(header + '\n')
+        return export_file
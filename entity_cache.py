@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Write-through cache of entity nodes.
+
+The same actors, activities and places appear in thousands of charters ('St. Katharinenspital', 'verkaufen',
+'Regensburg' ...). create_crm_entity_with_name looks them up in neo4j every time, although the node almost always
+exists already. The EntityCache keeps the most recently used nodes by (crm class, name) in memory and evicts the
+least recently used ones when it is full.
+
+The cache is thread-safe: if several threads ask for the same missing entity at the same time, only one of them
+fetches or creates it in neo4j, the others wait for its result. Nodes created by other processes are found in neo4j
+on the first miss, as before. The cache has to be invalidated if entity nodes are deleted, e.g. when the
+statements of changed charters are retracted: a GraphWriter created with the cache invalidates it after every
+retraction (see GraphWriter.filter_changed).
+
+The cache only lives in a single process. Nodes deleted by another process (another ingestion run retracting
+charters, or a cleared database) aren't noticed, so runs that retract charters must not run at the same time as a
+process relying on its cache.
+"""
+from __future__ import unicode_literals
+from collections import OrderedDict
+from neomodel import db
+import threading
+
+
+class EntityCache:
+
+    def __init__(self, maxsize=100000):
+        """
+        :param maxsize: maximum number of cached nodes
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+        # increased by every invalidation, nodes loaded before an invalidation aren't cached
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, load):
+        """
+        Return the cached node or load it
+
+        :param key: (crm class, name) of the node
+        :param load: function fetching or creating the node in neo4j
+        :return: the node
+        """
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    # move the node to the end of the LRU order
+                    entity = self._entries.pop(key)
+                    self._entries[key] = entity
+                    self.hits += 1
+                    return entity
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    generation = self._generation
+                    self.misses += 1
+                    break
+            # another thread is loading the node, use its result
+            loading.wait()
+
+        try:
+            entity = load()
+            with self._lock:
+                # the node may have been deleted while it was loaded
+                if generation == self._generation:
+                    self._put(key, entity)
+            return entity
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    def put(self, key, entity):
+        """
+        Add a node to the cache
+
+        :param key: (crm class, name) of the node
+        :param entity: the node
+        :return:
+        """
+        with self._lock:
+            self._put(key, entity)
+
+    def invalidate(self, key=None):
+        """
+        Remove a node or all nodes from the cache
+
+        :param key: (crm class, name) of the node, None removes all nodes
+        :return:
+        """
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def warm_up(self, models, labels):
+        """
+        Preload existing nodes of some crm classes, at most maxsize nodes in total
+
+        :param models: the crm models module
+        :param labels: list of crm classes, e.g. ['E21Person', 'E7Activity']
+        :return: the number of preloaded nodes
+        """
+        loaded = 0
+        for label in labels:
+            model = getattr(models, label)
+            rows, _ = db.cypher_query("MATCH (n:{0}) WHERE n.name IS NOT NULL RETURN n LIMIT $limit".format(label),
+                                      {'limit': self.maxsize - loaded})
+            for row in rows:
+                entity = model.inflate(row[0])
+                self.put((label, entity.name), entity)
+            loaded += len(rows)
+            if loaded >= self.maxsize:
+                break
+        return loaded
+
+    def _put(self, key, entity):
+        self._entries.pop(key, None)
+        self._entries[key] = entity
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
@@ -32,6 +32,12 @@ graph database using CIDOC-CRM ontology and NLP.
 from __future__ import unicode_literals
 from crm import models
 from neomodel import (config, StringProperty)
+from graph_writer import (GraphWriter, Neo4jStore)
+from local_graph import open_graph
+from parse_cache import abstract_hash
+from entity_cache import EntityCache
+from aliases import AliasIndex
+import model_cache
 import sys
 import json
 
@@ -58,11 +64,47 @@ node_fields = {
     'mom_id': StringProperty,
     #: Id of a related file (e.g. document, image...)
     'file_id': StringProperty,
+    #: Hash of the charter abstract the node was extracted from
+    'content_hash': StringProperty,
+    #: Version of the nlp pipeline the node was extracted with
+    'pipeline_version': StringProperty,
 
 }
 
-# Load crm model from crm model file
-models.build_models(config_file['cidoc-crm']['schema-file'], fields=node_fields)
+# Load crm model from crm model file (or from the model cache if the crm model file hasn't changed)
+model_cache.load_models(config_file['cidoc-crm']['schema-file'], node_fields, config_file['cidoc-crm']['model-cache'])
+
+# Graph backend: neo4j or the embedded local graph (see local_graph.py), which replaces the crm models
+graph = open_graph(config_file['backend']['type'], config_file['backend']['sqlite-file'])
+if graph is not None:
+    models = graph.models
+
+# Cache of entity nodes by crm class and name, so recurring entities are looked up in neo4j only once
+entity_cache = EntityCache(config_file['entity-cache']['size'])
+
+# Spelling variants of actors and places
+aliases = AliasIndex.load(config_file['aliases']['file'], config_file['aliases']['fuzzy-threshold'])
+
+
+def graph_store():
+    """
+    Return the graph store of the backend set in config.json, see GraphWriter
+
+    :return: the LocalGraph or a Neo4jStore
+    """
+    return graph if graph is not None else Neo4jStore()
+
+
+def warm_up_entity_cache():
+    """
+    Preload the entity cache with the nodes of the crm classes set in config.json. Only neo4j is preloaded, the
+    local graph is embedded and its lookups don't go over the network.
+
+    :return: the number of preloaded nodes
+    """
+    if graph is not None:
+        return 0
+    return entity_cache.warm_up(models, config_file['entity-cache']['warm-up'])
 
 
 def do_nlp(charter_abstract, charter, charter_id):
@@ -79,6 +121,19 @@ def do_nlp(charter_abstract, charter, charter_id):
     doc = nlp.spacy_dependency_parse(charter_abstract)
     # get triples or quadruples from deps
     dep_data = nlp.analyze_dep(doc)
+    # create entity nodes and connect them to the charter node
+    connect_entities(charter, dep_data)
+
+
+def connect_entities(charter, dep_data):
+    """
+    Create the entity nodes of a triple or quadruple in neo4j and connect them to the charter node
+
+    :param charter: the charter node that needs to be connected to its entities
+    :param dep_data: the triple or quadruple returned by NLP.analyze_dep
+    :return:
+    """
+
     # create activity node (the verb of a sentence is seen as the 'legal activity' described in the charter)
     activity = create_crm_entity_with_name("E7Activity", dep_data[1])
     # create main actor node
@@ -173,7 +228,8 @@ def do_nlp(charter_abstract, charter, charter_id):
 
 def create_crm_entity_with_name(entity_type, name):
     """
-    Create and return node in neo4j with crm label (if it wasn't already created)
+    Create and return node in neo4j with crm label (if it wasn't already created). Spelling variants of the name
+    are mapped to the same node, see AliasIndex.
 
     :param entity_type: the crm class
     :param name: the node name
@@ -181,11 +237,16 @@ def create_crm_entity_with_name(entity_type, name):
     """
 
     model = getattr(models, entity_type)
-    entity = model.nodes.get_or_none(name=name)
-    if entity is None:
-        entity = model(name=name)
-        entity.save()
-    return entity
+    name = aliases.resolve(name, entity_type)
+
+    def get_or_create():
+        entity = model.nodes.get_or_none(name=name)
+        if entity is None:
+            entity = model(name=name)
+            entity.save()
+        return entity
+
+    return entity_cache.get((entity_type, name), get_or_create)
 
 
 def example_1():
@@ -262,14 +323,50 @@ def example_2(charter_abstract, charter_id):
     do_nlp(charter_abstract, charter, charter_id)
 
 
+def example_3(charter_abstracts, batch_size=500, cache=None, incremental=False, metrics=None):
+    """
+    Generate example no. 3.
+
+    The same regesta graphs as in example no. 2 are being created in neo4j, but in batches.
+    1. The charter abstracts are parsed in batches with nlp.pipe.
+    2. The extracted entities and relations of many charters are collected and written with a few
+       UNWIND ... MERGE statements per batch instead of one round trip per node and relation.
+
+    Each charter node stores the hash of its abstract and the pipeline version. In incremental mode, charters that
+    didn't change are skipped and only the statements of changed charters are replaced.
+
+    :param charter_abstracts: list of (charter abstract, charter id) tuples
+    :param batch_size: number of charters written per transaction
+    :param cache: optional ParseCache, abstracts that were parsed before are not parsed again
+    :param incremental: only process new and changed charters
+    :param metrics: optional MetricsRegistry, the writes of the GraphWriter are measured
+    :return:
+    """
+
+    pipeline_version = nlp.pipeline_version
+    with GraphWriter(graph_store(), batch_size=batch_size, entity_cache=entity_cache) as writer:
+        if metrics is not None:
+            metrics.instrument(writer=writer)
+        if incremental:
+            charter_abstracts = writer.filter_changed(charter_abstracts, pipeline_version)
+        for doc, dep_data, charter_id in nlp.extract(charter_abstracts, cache=cache):
+            writer.add(charter_id, dep_data, content_hash=abstract_hash(doc.text), pipeline_version=pipeline_version)
+
+
 if __name__ == "__main__":
-    # delete db with cypher query
     from nlp import NLP
-    from neo4jrestclient.client import GraphDatabase
-
-    db = GraphDatabase("http://" + config_file['neo4j']['host'] + ":7474", username=config_file['neo4j']['user'],
-                       password=config_file['neo4j']['passwd'])
-    result = db.query("MATCH (n) OPTIONAL MATCH (n)-[r]-() DELETE n,r")
+    from parse_cache import ParseCache
+
+    # with --incremental the db is kept and only new and changed charters are processed
+    incremental = '--incremental' in sys.argv
+    if not incremental and graph is not None:
+        graph.clear()
+    elif not incremental:
+        from neo4jrestclient.client import GraphDatabase
+        # delete db with cypher query
+        db = GraphDatabase("http://" + config_file['neo4j']['host'] + ":7474", username=config_file['neo4j']['user'],
+                           password=config_file['neo4j']['passwd'])
+        result = db.query("MATCH (n) OPTIONAL MATCH (n)-[r]-() DELETE n,r")
 
     # example abstracts (in German)
     charter_abstracts = [
@@ -294,10 +391,25 @@ if __name__ == "__main__":
             "SpAR Urk. 86")
     ]
 
-    # setup nlp pipeline
-    nlp = NLP()
+    # setup nlp pipeline, the parsed abstracts are cached on disk
+    nlp = NLP(config_file['spacy']['model'], config_file['spacy']['components'], config_file['spacy']['lazy'],
+              fast_path=config_file['spacy']['fast-path'], aliases=aliases)
+    cache = ParseCache(config_file['spacy']['parse-cache'], nlp.model_key)
+
+    # with --metrics the stages are measured and the metrics are saved to metrics.json
+    metrics = None
+    if '--metrics' in sys.argv:
+        from metrics import MetricsRegistry
+        metrics = MetricsRegistry()
+        metrics.instrument(nlp=nlp, module=sys.modules[__name__], entity_cache=entity_cache, parse_cache=cache)
+        metrics.start_reporter()
 
     # execute examples and create neo4j db
-    example_1()
-    for charter_abstract, charter_id in charter_abstracts:
-        example_2(charter_abstract, charter_id)
+    if not incremental:
+        example_1()
+    example_3(charter_abstracts, cache=cache, incremental=incremental, metrics=metrics)
+    print(nlp.report())
+    if metrics is not None:
+        metrics.stop_reporter()
+        print(metrics.summary())
+        metrics.dump('metrics.json')
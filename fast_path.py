@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Fast path for formulaic charter abstracts.
+
+Most of Katharinenspital's regesta follow a few fixed templates, e.g.
+
+    Ulrich von Abbach verkauft dem Spital sein Gut in Teingen um 15 Pfennig.
+    Rudger vermacht dem St. Katharinenspital zwei Äcker zu Chesching.
+
+Abstracts like these can be recognised with spaCy's rule-based Matcher on the output of the tokenizer alone, which
+is a lot faster than running the tagger, the parser and the entity recognizer. A matching abstract is annotated with
+the dependency parse the parser assigns to the template: the subject and the spital are merged into single tokens like
+named entities, and tags, labels, heads and lemmas are set. NLP.analyze_deps then extracts the quadruple from the
+annotated doc exactly like from a parsed one, all other abstracts have to be parsed.
+
+The lemmas of the annotated doc are the ones of the tokenizer's lookup tables if spaCy provides them for the language,
+otherwise the text. The verbs of the templates have fixed lemmas.
+
+See: https://spacy.io/usage/rule-based-matching
+"""
+from __future__ import unicode_literals
+from spacy.attrs import (DEP, HEAD, LEMMA, POS)
+from spacy.matcher import Matcher
+import numpy
+import spacy
+
+# version of the templates and their annotation, bump it whenever the fast path produces different results
+TEMPLATE_VERSION = 2
+
+# verbs of the templates and their lemmas
+VERBS = {
+    'verkauft': 'verkaufen',
+    'vermacht': 'vermachen',
+    'verschafft': 'verschaffen',
+    'schenkt': 'schenken',
+    'stiftet': 'stiften',
+    'verstiftet': 'verstiften',
+}
+# spellings of 'St. Katharinenspital'
+SPITAL = ('St. Katharinenspital', 'St.-Katharinenspital', 'Katharinenspital', 'Spital')
+# determiners and numerals in front of the indirect object
+DETERMINERS = ['sein', 'seine', 'seinen', 'ihr', 'ihre', 'ihren', 'ein', 'eine', 'einen', 'den', 'die', 'das',
+               'zwei', 'drei', 'vier']
+# name particles of subjects like 'Ulrich von Abbach'
+PARTICLES = ['von', 'v.', 'de', 'vom']
+# articles in front of places
+ARTICLES = ['der', 'dem', 'den']
+# these prepositions are used to check if a noun is a place (see RelationExtractor)
+LOC_ATT = ['im', 'zu', 'gegenüber', 'in', 'neben', 'beim', 'bei', 'samt']
+# these prepositions are used to analyse and determine a 'E30Right' (see RelationExtractor)
+RIGHT_ATT = ['durch', 'auf', 'von', 'über', 'um']
+
+
+class TemplateMatcher:
+
+    def __init__(self, lang='de'):
+        """
+        :param lang: language of the tokenizer
+        """
+        self.nlp = spacy.blank(lang)
+        self.matcher = Matcher(self.nlp.vocab)
+        self.hits = 0
+        self.misses = 0
+        subjects = [
+            [{'IS_TITLE': True}],
+            [{'IS_TITLE': True}, {'LOWER': {'IN': PARTICLES}}, {'IS_TITLE': True}],
+        ]
+        tails = {
+            'place': [{'LOWER': {'IN': LOC_ATT}}, {'LOWER': {'IN': ARTICLES}, 'OP': '?'}, {'IS_TITLE': True}],
+            'right': [{'LOWER': {'IN': RIGHT_ATT}}, {'LIKE_NUM': True, 'OP': '?'}, {'IS_TITLE': True}],
+        }
+        for template, tail in tails.items():
+            patterns = []
+            for spital in SPITAL:
+                # spell the spital the way the tokenizer splits it
+                spital = [{'ORTH': token.text} for token in self.nlp.tokenizer(spital)]
+                for subject in subjects:
+                    patterns.append(subject + [{'LOWER': {'IN': list(VERBS)}}, {'LOWER': 'dem'}] + spital +
+                                    [{'LOWER': {'IN': DETERMINERS}, 'OP': '?'}, {'IS_TITLE': True}] + tail)
+            self.matcher.add(template, patterns)
+
+    def match(self, charter_abstract):
+        """
+        Match a charter abstract against the templates
+
+        :param charter_abstract: the charter abstract
+        :return: the tokenized doc, annotated if the abstract follows a template, and whether it does
+        """
+        doc = self.nlp.make_doc(charter_abstract)
+        ends = [end for _, start, end in self.matcher(doc) if start == 0]
+        if not ends:
+            self.misses += 1
+            return doc, False
+        self.hits += 1
+        return self.annotate(doc, max(ends)), True
+
+    def annotate(self, doc, end):
+        """
+        Annotate a doc matching a template with the dependency parse of the template, e.g.
+
+            Ulrich von Abbach   verkauft   dem   Spital   sein   Gut   in    Teingen   um   15   Pfennig   .
+            sb                  ROOT       nk    da       nk     oa    mnr   nk        mo   mo   mo        punct
+
+        :param doc: the tokenized doc
+        :param end: end of the match, the match starts at the first token
+        :return: the annotated doc
+        """
+        verb = next(token.i for token in doc[:end] if token.lower_ in VERBS)
+        # the indirect object is in front of the preposition of the tail
+        preposition = end - 1
+        while doc[preposition].lower_ not in LOC_ATT + RIGHT_ATT:
+            preposition -= 1
+        dobject2 = preposition - 1
+        # the spital follows 'dem' and is followed by an optional determiner
+        spital_end = dobject2 - 1 if doc[dobject2 - 1].lower_ in DETERMINERS else dobject2
+        # character offsets of the tokens survive the merges
+        offsets = [doc[i].idx for i in (verb, verb + 1, spital_end, dobject2, preposition, end - 1)]
+        with doc.retokenize() as retokenizer:
+            retokenizer.merge(doc[0:verb], attrs={'LEMMA': doc[0:verb].text})
+            retokenizer.merge(doc[verb + 2:spital_end], attrs={'LEMMA': doc[verb + 2:spital_end].text})
+        index = dict((token.idx, token.i) for token in doc)
+        verb, article, determiner, dobject2, preposition, place = [index[offset] for offset in offsets]
+
+        # every other token is attached to the verb
+        heads = [verb] * len(doc)
+        deps = ['punct' if token.is_punct else 'mo' for token in doc]
+        pos = ['PUNCT' if token.is_punct else 'NUM' if token.like_num else 'X' for token in doc]
+        lemmas = [token.lemma_ or token.text for token in doc]
+        annotation = [(0, 'sb', 'PROPN', verb), (verb, 'ROOT', 'VERB', verb), (article, 'nk', 'DET', article + 1),
+                      (article + 1, 'da', 'PROPN', verb), (dobject2, 'oa', 'NOUN', verb),
+                      (preposition, 'mnr', 'ADP', dobject2), (place, 'nk', 'NOUN', preposition)]
+        if determiner < dobject2:
+            annotation.append((determiner, 'nk', 'DET', dobject2))
+        # an article or a numeral in front of the place
+        if preposition + 1 < place:
+            annotation.append((preposition + 1, 'nk', 'NUM' if doc[preposition + 1].like_num else 'DET', place))
+        for i, dep, tag, head in annotation:
+            heads[i], deps[i], pos[i] = head, dep, tag
+        lemmas[verb] = VERBS[doc[verb].lower_]
+
+        strings = doc.vocab.strings
+        # heads are stored relative to the token, as unsigned 64 bit values like the string ids
+        rows = [[(head - i) % 2 ** 64, strings.add(dep), strings.add(tag), strings.add(lemma)]
+                for i, (head, dep, tag, lemma) in enumerate(zip(heads, deps, pos, lemmas))]
+        return doc.from_array([HEAD, DEP, POS, LEMMA], numpy.array(rows, dtype=numpy.uint64))
+
+    def hit_rate(self):
+        """
+        :return: share of the matched abstracts which follow a template
+        """
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Batched writer for regesta graphs.
+
+do_nlp in examples.py creates every node and every relationship of a charter with its own neo4j round trip. The
+GraphWriter collects the nodes and relationships of many charters instead and sends them as a few parameterised
+UNWIND ... MERGE statements per batch, grouped by CRM label and relationship type:
+
+    UNWIND $rows AS row MERGE (n:E21Person {name: row.name}) SET n:E21Person:E39Actor:...
+
+Labels and relationship types are taken from the CRM classes built by crm4j, so the resulting graph is the same
+as the one created by do_nlp. The statements of a batch are collected in a StagingGraph (see staging.py), which
+deduplicates nodes and relationships before they are written.
+
+Every relationship written by the GraphWriter records the ids of the charters it was extracted from in its
+'charters' property. This allows incremental ingestion: charters whose abstract and pipeline version didn't change
+are skipped, and the statements of changed charters are retracted before they are written again, without touching
+the statements of other charters.
+
+See: https://neo4j.com/docs/cypher-manual/current/clauses/unwind/
+"""
+from __future__ import unicode_literals
+from crm import models
+from neomodel import db
+from parse_cache import abstract_hash
+from staging import StagingGraph
+
+
+def charter_statements(charter_id, dep_data):
+    """
+    Translate the triple or quadruple extracted from a charter abstract into CRM nodes and relationships. The
+    statements are the same do_nlp creates in neo4j.
+
+    :param charter_id: the charter id used by the archive
+    :param dep_data: the triple or quadruple returned by NLP.analyze_dep
+    :return: list of (crm class, name) nodes and list of (source node, crm property, target node) relationships
+    """
+    charter = ("E5Event", charter_id)
+    nodes = [charter]
+    relationships = []
+    # nothing could be extracted from the charter abstract
+    if len(dep_data) < 2:
+        return nodes, relationships
+
+    activity = ("E7Activity", dep_data[1])
+    actor = ("E21Person", dep_data[0])
+    nodes += [activity, actor]
+    relationships += [
+        (charter, "P11_had_participant", actor),
+        (activity, "P14_carried_out_by", actor),
+        (activity, "P11_had_participant", actor),
+        (charter, "P9_consists_of", activity),
+    ]
+
+    # quadruple: subject, verb, dobject, dobject2
+    if len(dep_data) == 4:
+        actor2 = ("E21Person", dep_data[2])
+        nodes.append(actor2)
+        relationships += [
+            (charter, "P11_had_participant", actor2),
+            (activity, "P11_had_participant", actor2),
+        ]
+
+        # dobject2 already has a crm class
+        if not isinstance(dep_data[3], basestring):
+            # dobject2 is a 'E30Right' like 'Ablass', 'Recht', 'Streit' etc.
+            if dep_data[3][0] == "E30Right":
+                right = ("E30Right", dep_data[3][1])
+                nodes.append(right)
+                relationships += [
+                    (actor, "P75_possesses", right),
+                    (actor2, "P75_possesses", right),
+                    (right, "P129_is_about", activity),
+                    (right, "P129_is_about", charter),
+                ]
+            # dobject2 is a 'E53Place' with further details like "...[Grund] in(!) der Stadt [Regensburg]"
+            else:
+                place = ("E53Place", dep_data[3][0])
+                place2 = ("E53Place", dep_data[3][1])
+                nodes += [place, place2]
+                relationships += [
+                    (place2, "P89_falls_within", place),
+                    (charter, "P161_has_spatial_projection", place2),
+                    (activity, "P161_has_spatial_projection", place),
+                    (charter, "P161_has_spatial_projection", place),
+                ]
+        # dobject2 is a 'E53Place' like 'Regensburg', 'Gut', 'Wiese', 'Grund'
+        else:
+            place = ("E53Place", dep_data[3])
+            nodes.append(place)
+            relationships += [
+                (activity, "P161_has_spatial_projection", place),
+                (charter, "P161_has_spatial_projection", place),
+            ]
+
+    return nodes, relationships
+
+
+# crm classes of the nodes created by charter_statements
+LABELS = ("E5Event", "E7Activity", "E21Person", "E30Right", "E53Place")
+
+# (crm class, crm property) -> relationship type and direction, see relationship_type
+_relationship_types = {}
+
+
+def relationship_type(label, prop):
+    """
+    Look up the relationship type and direction crm4j uses for a CRM property
+
+    :param label: the crm class of the source node
+    :param prop: the crm property, e.g. 'P11_had_participant'
+    :return: relationship type and direction
+    """
+    key = (label, prop)
+    if key not in _relationship_types:
+        definition = getattr(getattr(models, label), prop).definition
+        _relationship_types[key] = (definition['relation_type'], definition['direction'])
+    return _relationship_types[key]
+
+
+class Neo4jStore:
+    """
+    Send batches of nodes and relationships to neo4j, one UNWIND statement per CRM label and relationship type.
+    All statements of a batch are executed in a single transaction.
+
+    Several stores may write at the same time (see pipeline.py). MERGE alone doesn't keep two transactions from
+    creating the same new node, so the names have to be unique per crm class, see ensure_constraints. The charter ids
+    of a relationship are only updated after the relationship is locked, so concurrent writers don't lose each
+    other's charter ids.
+    """
+
+    def ensure_constraints(self, labels=LABELS):
+        """
+        Create uniqueness constraints on the names of the nodes of some crm classes, if they don't exist yet
+
+        :param labels: list of crm classes
+        :return:
+        """
+        for label in labels:
+            try:
+                db.cypher_query("CREATE CONSTRAINT ON (n:{0}) ASSERT n.name IS UNIQUE".format(label))
+            except Exception as e:
+                # neo4j 4 refuses to create a constraint twice, neo4j 3 ignores it
+                if 'EquivalentSchemaRuleAlreadyExists' not in '{0}'.format(getattr(e, 'code', e)):
+                    raise
+
+    def write(self, nodes, relationships):
+        """
+        Merge a batch of nodes and relationships into neo4j
+
+        :param nodes: dict of crm class -> list of {'name': ..., 'props': {...}} rows
+        :param relationships: dict of (source crm class, relationship type, target crm class) -> list of
+            {'src': ..., 'dst': ..., 'charters': [...]} rows
+        :return:
+        """
+        with db.transaction:
+            for label, rows in nodes.items():
+                labels = ":".join(getattr(models, label).inherited_labels())
+                db.cypher_query("UNWIND $rows AS row "
+                                "MERGE (n:{0} {{name: row.name}}) "
+                                "SET n:{1} "
+                                "SET n += row.props".format(label, labels), {'rows': rows})
+            for (src_label, rel_type, dst_label), rows in relationships.items():
+                db.cypher_query("UNWIND $rows AS row "
+                                "MATCH (a:{0} {{name: row.src}}) "
+                                "MATCH (b:{2} {{name: row.dst}}) "
+                                "MERGE (a)-[r:{1}]->(b) "
+                                # take the write lock before the charter ids are read
+                                "SET r._lock = true "
+                                "SET r.charters = coalesce(r.charters, []) + "
+                                "[c IN row.charters WHERE NOT c IN coalesce(r.charters, [])] "
+                                "REMOVE r._lock"
+                                .format(src_label, rel_type, dst_label), {'rows': rows})
+
+    def charter_state(self, charter_ids):
+        """
+        Return content hash and pipeline version of charters that were already written
+
+        :param charter_ids: list of charter ids
+        :return: dict of charter id -> (content hash, pipeline version)
+        """
+        rows, _ = db.cypher_query("MATCH (c:E5Event) WHERE c.name IN $ids "
+                                  "RETURN c.name, c.content_hash, c.pipeline_version", {'ids': charter_ids})
+        return dict((name, (content_hash, pipeline_version)) for name, content_hash, pipeline_version in rows)
+
+    def retract(self, charter_ids):
+        """
+        Remove the statements of charters from neo4j. Relationships are only deleted if no other charter refers to
+        them, entity nodes only if they aren't connected anymore. The charter nodes themselves are kept, but lose
+        their content hash and pipeline version in the same transaction. If the process dies before the charters are
+        written again, the next incremental run doesn't take them for unchanged.
+
+        :param charter_ids: list of charter ids
+        :return:
+        """
+        with db.transaction:
+            db.cypher_query("UNWIND $ids AS id "
+                            "MATCH (c:E5Event {name: id}) "
+                            "REMOVE c.content_hash, c.pipeline_version", {'ids': charter_ids})
+            # every statement of a charter connects the charter or two of its neighbours
+            db.cypher_query("UNWIND $ids AS id "
+                            "MATCH (:E5Event {name: id})--(n)-[r]-() "
+                            "WHERE id IN coalesce(r.charters, []) "
+                            "WITH DISTINCT id, r "
+                            "SET r.charters = [c IN r.charters WHERE c <> id]", {'ids': charter_ids})
+            db.cypher_query("UNWIND $ids AS id "
+                            "MATCH (:E5Event {name: id})--(n)-[r]-() "
+                            "WHERE r.charters = [] "
+                            "WITH DISTINCT r "
+                            "DELETE r", {'ids': charter_ids})
+            db.cypher_query("UNWIND $ids AS id "
+                            "MATCH (:E5Event {name: id})-[r]-(n) "
+                            "WITH collect(DISTINCT n) AS neighbours, collect(DISTINCT r) AS rels "
+                            "FOREACH (r IN rels | DELETE r) "
+                            "WITH neighbours "
+                            "UNWIND neighbours AS n "
+                            "WITH n WHERE NOT (n)--() "
+                            "DELETE n", {'ids': charter_ids})
+
+
+class GraphWriter:
+    """
+    Collect the CRM nodes and relationships of many charters and write them in batches.
+
+    Usage:
+
+        with GraphWriter() as writer:
+            for doc, charter_id in nlp.pipe_dependency_parse(charter_abstracts):
+                writer.add(charter_id, nlp.analyze_dep(doc))
+
+    Incremental ingestion only parses and writes new or changed charters:
+
+        with GraphWriter() as writer:
+            changed = writer.filter_changed(charter_abstracts, nlp.pipeline_version)
+            for doc, charter_id in nlp.pipe_dependency_parse(changed):
+                writer.add(charter_id, nlp.analyze_dep(doc), content_hash=abstract_hash(doc.text),
+                           pipeline_version=nlp.pipeline_version)
+    """
+
+    def __init__(self, store=None, batch_size=500, skip_written=True, entity_cache=None):
+        """
+        :param store: the graph store the batches are written to (default: neo4j)
+        :param batch_size: number of charters per batch
+        :param skip_written: don't write entity nodes again which were written in an earlier batch. Has to be
+            disabled if another writer may retract charters from the same graph store at the same time.
+        :param entity_cache: optional EntityCache of the same process, invalidated when charters are retracted
+        """
+        self.store = store if store is not None else Neo4jStore()
+        self.batch_size = batch_size
+        self.skip_written = skip_written
+        self.entity_cache = entity_cache
+        self.staging = StagingGraph()
+        self.written = 0
+        self.skipped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, charter_id, dep_data, **charter_fields):
+        """
+        Add the statements of a charter to the current batch. The batch is written once it is full.
+
+        :param charter_id: the charter id used by the archive
+        :param dep_data: the triple or quadruple returned by NLP.analyze_dep
+        :param charter_fields: additional attributes of the charter node, e.g. 'file_id' or 'mom_id'
+        :return:
+        """
+        nodes, relationships = charter_statements(charter_id, dep_data)
+        self.staging.add(charter_id, nodes, relationships, charter_fields)
+        if len(self.staging) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the current batch to the graph store
+
+        :return:
+        """
+        if not len(self.staging):
+            return
+        nodes, relationships = self.staging.export(relationship_type)
+        self.store.write(nodes, relationships)
+        self.written += len(self.staging)
+        if self.skip_written:
+            self.staging.mark_written()
+        self.clear()
+
+    def clear(self):
+        """
+        Drop the current batch without writing it, e.g. after a failed flush
+
+        :return:
+        """
+        self.staging.clear()
+
+    def filter_changed(self, charter_abstracts, pipeline_version, get_id=None, on_error=None):
+        """
+        Skip charters that were already written with the same abstract and pipeline version. The statements of
+        changed charters are retracted from the graph store, so they can be written again.
+
+        :param charter_abstracts: iterable of (charter abstract, charter id) tuples
+        :param pipeline_version: the pipeline version, see NLP.pipeline_version
+        :param get_id: function returning the charter id of the second tuple element (default: the element itself)
+        :param on_error: function called with the charter ids of a chunk and the error if the graph store fails to
+            check or retract them, the chunk is dropped and the stream goes on (default: the error is raised)
+        :return: generator of the tuples of new and changed charters
+        """
+        if get_id is None:
+            get_id = lambda charter_id: charter_id
+        chunk = []
+        for item in charter_abstracts:
+            chunk.append(item)
+            if len(chunk) >= self.batch_size:
+                for changed in self._filter_chunk(chunk, pipeline_version, get_id, on_error):
+                    yield changed
+                chunk = []
+        for changed in self._filter_chunk(chunk, pipeline_version, get_id, on_error):
+            yield changed
+
+    def _filter_chunk(self, chunk, pipeline_version, get_id, on_error=None):
+        if not chunk:
+            return []
+        try:
+            return self._retract_changed(chunk, pipeline_version, get_id)
+        except Exception as e:
+            # the retraction may have been partly done
+            self.staging.forget_written()
+            if self.entity_cache is not None:
+                self.entity_cache.invalidate()
+            if on_error is None:
+                raise
+            on_error([get_id(context) for _, context in chunk], e)
+            return []
+
+    def _retract_changed(self, chunk, pipeline_version, get_id):
+        state = self.store.charter_state([get_id(context) for _, context in chunk])
+        changed = [(charter_abstract, context) for charter_abstract, context in chunk
+                   if state.get(get_id(context)) != (abstract_hash(charter_abstract), pipeline_version)]
+        retracted = [get_id(context) for _, context in changed if get_id(context) in state]
+        if retracted:
+            self.store.retract(retracted)
+            # the graph store may have deleted entities which are now orphaned
+            self.staging.forget_written()
+            if self.entity_cache is not None:
+                self.entity_cache.invalidate()
+        self.skipped += len(chunk) - len(changed)
+        return changed
+
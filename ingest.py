@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Streaming ingestion of regesta sources into neo4j.
+
+The sources are read lazily and passed through a chain of generators:
+
+    read sources -> NLP.extract (fast path or parse and analyze_deps) -> GraphWriter
+
+so only one batch of charters is held in memory at a time, no matter how large the corpus is. After every batch
+written to neo4j, the position in the sources is saved to a checkpoint file. An interrupted run started again with
+the same sources and checkpoint file resumes after the last written batch.
+
+Supported sources:
+
+ - directories of regesta files (urkNNNN.txt), one abstract per file
+ - JSONL files, one JSON object per line with 'abstract' and 'charter_id' (optional 'arch_id', 'mom_id', 'file_id')
+ - CSV files with a header row and the same columns
+
+Usage:
+
+    $ python ingest.py regesta/ more_regesta.jsonl --checkpoint ingest.checkpoint
+
+The first load of a whole archive is a lot faster with neo4j's offline importer. With --export the graph is written
+to CSV files for neo4j-admin import instead of neo4j (see bulk_export.py):
+
+    $ python ingest.py regesta/ --export export/
+"""
+from __future__ import unicode_literals
+from analytics import CoParticipation
+from bulk_export import CSVExportStore
+from examples import (aliases, config_file, graph_store)
+from graph_writer import GraphWriter
+from metrics import MetricsRegistry
+from nlp import NLP
+from parse_cache import (abstract_hash, ParseCache)
+import argparse
+import csv
+import io
+import json
+import os
+import re
+
+# optional attributes of charter nodes
+CHARTER_FIELDS = ('arch_id', 'mom_id', 'file_id')
+
+
+def read_sources(sources, id_prefix='SpAR Urk.', skip=0, skipped=None):
+    """
+    Read charter records from regesta sources. Records without an abstract or a charter id are skipped and logged,
+    they still count as a position of the sources.
+
+    :param sources: list of directories, JSONL and CSV files
+    :param id_prefix: prefix of the charter ids derived from regesta file names, e.g. 'SpAR Urk.' for urk0035.txt
+    :param skip: number of records to skip, e.g. when resuming from a checkpoint
+    :param skipped: optional list, the positions of skipped records are appended to it
+    :return: generator of charter records (dicts with 'position', 'abstract', 'charter_id' and charter fields)
+    """
+    position = 0
+    for source in sources:
+        if os.path.isdir(source):
+            records = read_directory(source, id_prefix, max(skip - position, 0))
+        elif source.endswith('.csv'):
+            records = read_csv(source)
+        else:
+            records = read_jsonl(source)
+        for record in records:
+            if position >= skip:
+                if not record.get('abstract') or not record.get('charter_id'):
+                    print('record {0} skipped, no abstract or charter id: {1}'.format(position, source))
+                    if skipped is not None:
+                        skipped.append(position)
+                else:
+                    record['position'] = position
+                    yield record
+            position += 1
+
+
+def read_directory(directory, id_prefix, skip=0):
+    """
+    Read regesta files (urkNNNN.txt) from a directory in the order of their numbers. Skipped files aren't opened.
+
+    :param directory: the directory
+    :param id_prefix: prefix of the charter ids, the charter id of urk0035.txt is '<id_prefix> 35'
+    :param skip: number of files to skip
+    :return: generator of charter records, None for skipped files
+    """
+    files = sorted((int(match.group(1)), name) for name, match in
+                   ((name, re.match(r'urk(\d+)\.txt$', name)) for name in os.listdir(directory)) if match)
+    for i, (number, name) in enumerate(files):
+        if i < skip:
+            yield None
+            continue
+        with io.open(os.path.join(directory, name), encoding='utf-8') as regesta_file:
+            abstract = ' '.join(regesta_file.read().split())
+        charter_id = '{0} {1}'.format(id_prefix, number)
+        yield {'abstract': abstract, 'charter_id': charter_id, 'arch_id': charter_id, 'file_id': name}
+
+
+def read_jsonl(path):
+    """
+    Read charter records from a JSONL file
+
+    :param path: the JSONL file
+    :return: generator of charter records, an empty record for lines that aren't valid JSON objects
+    """
+    with io.open(path, encoding='utf-8') as jsonl_file:
+        for line in jsonl_file:
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                yield record if isinstance(record, dict) else {}
+
+
+def read_csv(path):
+    """
+    Read charter records from a CSV file with a header row
+
+    :param path: the CSV file
+    :return: generator of charter records, an empty record for rows with more fields than the header
+    """
+    with open(path, 'rb') as csv_file:
+        for row in csv.DictReader(csv_file):
+            # the extra fields are stored under the key None, the fields of the row can't be trusted
+            if None in row:
+                yield {}
+                continue
+            yield dict((key.decode('utf-8'), value.decode('utf-8')) for key, value in row.items() if value)
+
+
+def load_checkpoint(path, sources):
+    """
+    Return the number of records already written by a previous run with the same sources
+
+    :param path: the checkpoint file
+    :param sources: list of sources
+    :return: the number of records to skip
+    """
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint['sources'] != sources:
+        return 0
+    return checkpoint['position']
+
+
+def save_checkpoint(path, sources, position):
+    """
+    Save the number of records written so far
+
+    :param path: the checkpoint file
+    :param sources: list of sources
+    :param position: the number of records written
+    :return:
+    """
+    # replace the checkpoint atomically, so a crash while saving never loses the previous checkpoint
+    with open(path + '.tmp', 'w') as checkpoint_file:
+        json.dump({'sources': sources, 'position': position}, checkpoint_file)
+    os.rename(path + '.tmp', path)
+
+
+def ingest(nlp, sources, writer, checkpoint=None, incremental=False, cache=None, batch_size=64, n_process=1,
+           id_prefix='SpAR Urk.', analytics=None, analytics_cache=None):
+    """
+    Stream charter records from the sources into the graph
+
+    :param nlp: the NLP pipeline
+    :param sources: list of directories, JSONL and CSV files
+    :param writer: the GraphWriter
+    :param checkpoint: optional checkpoint file
+    :param incremental: only process new and changed charters
+    :param cache: optional ParseCache
+    :param batch_size: number of abstracts per parser batch
+    :param n_process: number of parser processes
+    :param id_prefix: prefix of the charter ids derived from regesta file names
+    :param analytics: optional CoParticipation, the actors of the written charters are added to it. Runs which skip
+        charters already in the graph (resumed or incremental) first read the charters written since the
+        CoParticipation was saved from the graph.
+    :param analytics_cache: directory the CoParticipation is saved to at the end of the run
+    :return: the number of records written
+    """
+    skip = load_checkpoint(checkpoint, sources)
+    pipeline_version = nlp.pipeline_version
+    # the analytics are only saved at the end, an interrupted run may have written charters they don't contain
+    if analytics is not None and (skip or incremental):
+        print('{0} charters of the co-participation analytics read from the graph'.format(analytics.load_graph()))
+    skipped = []
+    records = ((record.pop('abstract'), record) for record in read_sources(sources, id_prefix, skip, skipped))
+    if incremental:
+        records = writer.filter_changed(records, pipeline_version, get_id=lambda record: record['charter_id'])
+
+    position = skip
+    written = writer.written
+    for doc, dep_data, record in nlp.extract(records, batch_size, n_process, cache):
+        content_hash = abstract_hash(doc.text)
+        writer.add(record['charter_id'], dep_data, content_hash=content_hash, pipeline_version=pipeline_version,
+                   **dict((str(field), record[field]) for field in CHARTER_FIELDS if field in record))
+        if analytics is not None:
+            analytics.add_extraction(record['charter_id'], dep_data, (content_hash, pipeline_version))
+        position = record['position'] + 1
+        # the writer has written a batch
+        if writer.written != written:
+            written = writer.written
+            if checkpoint:
+                save_checkpoint(checkpoint, sources, position)
+            print('{0} records processed, {1} charters written'.format(position, written))
+    writer.flush()
+    # skipped records after the last written record
+    if skipped:
+        position = max(position, skipped[-1] + 1)
+        print('{0} records skipped'.format(len(skipped)))
+    if analytics is not None and analytics_cache:
+        analytics.save(analytics_cache)
+    if checkpoint:
+        save_checkpoint(checkpoint, sources, position)
+    return position - skip
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stream regesta sources into neo4j.')
+    parser.add_argument('sources', nargs='+', help='directories of urkNNNN.txt files, JSONL or CSV files')
+    parser.add_argument('--checkpoint', help='checkpoint file used to resume interrupted runs')
+    parser.add_argument('--incremental', action='store_true', help='only process new and changed charters')
+    parser.add_argument('--parse-cache', action='store_true', help='use the parse cache set in config.json')
+    parser.add_argument('--batch-size', type=int, default=64, help='number of abstracts per parser batch')
+    parser.add_argument('--write-batch-size', type=int, default=500, help='number of charters per transaction')
+    parser.add_argument('--n-process', type=int, default=1, help='number of parser processes')
+    parser.add_argument('--id-prefix', default='SpAR Urk.', help='prefix of charter ids derived from file names')
+    parser.add_argument('--export', metavar='DIR', help='write CSV files for neo4j-admin import instead of neo4j')
+    parser.add_argument('--analytics', action='store_true', help='update the co-participation matrices set in '
+                                                                 'config.json')
+    parser.add_argument('--metrics', metavar='FILE', help='measure the stages and save the metrics to a JSON file')
+    parser.add_argument('--report-interval', type=float, default=60, help='seconds between two metrics summaries')
+    args = parser.parse_args()
+    if args.export and (args.incremental or args.checkpoint):
+        parser.error('an export is always written from scratch, --export can\'t be combined with --incremental '
+                     'or --checkpoint')
+
+    nlp = NLP(config_file['spacy']['model'], config_file['spacy']['components'], config_file['spacy']['lazy'],
+              fast_path=config_file['spacy']['fast-path'], aliases=aliases)
+    cache = ParseCache(config_file['spacy']['parse-cache'], nlp.model_key) if args.parse_cache else None
+    store = CSVExportStore(args.export) if args.export else graph_store()
+    metrics = MetricsRegistry() if args.metrics else None
+    analytics = CoParticipation.load(config_file['analytics']['cache']) if args.analytics else None
+    with GraphWriter(store, batch_size=args.write_batch_size) as writer:
+        if metrics is not None:
+            metrics.instrument(nlp=nlp, writer=writer, parse_cache=cache)
+            metrics.start_reporter(args.report_interval)
+        ingest(nlp, args.sources, writer, checkpoint=args.checkpoint, incremental=args.incremental, cache=cache,
+               batch_size=args.batch_size, n_process=args.n_process, id_prefix=args.id_prefix, analytics=analytics,
+               analytics_cache=config_file['analytics']['cache'])
+    if args.export:
+        store.close()
+        print('{0} nodes and {1} relationships exported, import them with:'.format(store.nodes_written,
+                                                                                    store.relationships_written))
+        print(store.import_command())
+    print(nlp.report())
+    if metrics is not None:
+        metrics.stop_reporter()
+        print(metrics.summary())
+        metrics.dump(args.metrics)
@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-process stand-ins for neo4j.
+
+The MemoryStore can be passed to the GraphWriter instead of the Neo4jStore. It keeps nodes and relationships in
+dictionaries and follows the same merge semantics, so benchmarks and dry runs don't need a running neo4j server.
+
+The LocalGraph is an embedded graph backend stored in SQLite, in a file or in memory. It is a graph store for the
+GraphWriter and also provides the part of the neomodel API used by examples.py, so do_nlp and
+create_crm_entity_with_name run without neo4j as well:
+
+    graph = LocalGraph('.local_graph.sqlite')
+    charter = graph.models.E5Event(name='SpAR Urk. 35')
+    charter.save()
+    actor = graph.models.E21Person.nodes.get_or_none(name='Otto Prager')
+    if not charter.P11_had_participant.is_connected(actor):
+        charter.P11_had_participant.connect(actor)
+
+Nodes are unique by crm class and name, like the nodes merged by the GraphWriter, and are looked up by their crm
+class. Relationships are unique by source node, relationship type and target node. Both lookups are backed by an
+index. Relationship types and directions are the ones crm4j uses in neo4j.
+
+The backend is chosen in the 'backend' section of config.json, see open_graph.
+
+See: https://www.sqlite.org/lang_createindex.html
+"""
+from __future__ import unicode_literals
+from crm import models
+from graph_writer import relationship_type
+from neomodel.relationship_manager import (EITHER, INCOMING)
+import json
+import sqlite3
+import threading
+
+# maximum number of parameters of an IN (...) clause, SQLite allows 999 parameters per statement
+IN_LIMIT = 500
+
+
+class MemoryStore:
+
+    def __init__(self):
+        # (crm class, name) -> node properties
+        self.nodes = {}
+        # (source node, relationship type, target node) -> ids of the charters the relationship was extracted from
+        self.relationships = {}
+        # node -> relationships of the node
+        self._adjacency = {}
+
+    def write(self, nodes, relationships):
+        """
+        Merge a batch of nodes and relationships, see Neo4jStore.write
+
+        :param nodes: dict of crm class -> list of {'name': ..., 'props': {...}} rows
+        :param relationships: dict of (source crm class, relationship type, target crm class) -> list of
+            {'src': ..., 'dst': ..., 'charters': [...]} rows
+        :return:
+        """
+        for label, rows in nodes.items():
+            for row in rows:
+                self.nodes.setdefault((label, row['name']), {}).update(row['props'])
+        for (src_label, rel_type, dst_label), rows in relationships.items():
+            for row in rows:
+                src, dst = (src_label, row['src']), (dst_label, row['dst'])
+                # relationships are only created between existing nodes, like MATCH ... MERGE
+                if src not in self.nodes or dst not in self.nodes:
+                    continue
+                key = (src, rel_type, dst)
+                if key not in self.relationships:
+                    self.relationships[key] = set()
+                    self._adjacency.setdefault(src, set()).add(key)
+                    self._adjacency.setdefault(dst, set()).add(key)
+                self.relationships[key].update(row['charters'])
+
+    def charter_state(self, charter_ids):
+        """
+        Return content hash and pipeline version of charters that were already written
+
+        :param charter_ids: list of charter ids
+        :return: dict of charter id -> (content hash, pipeline version)
+        """
+        state = {}
+        for charter_id in charter_ids:
+            props = self.nodes.get(("E5Event", charter_id))
+            if props is not None:
+                state[charter_id] = (props.get('content_hash'), props.get('pipeline_version'))
+        return state
+
+    def retract(self, charter_ids):
+        """
+        Remove the statements of charters, see Neo4jStore.retract
+
+        :param charter_ids: list of charter ids
+        :return:
+        """
+        for charter_id in charter_ids:
+            charter = ("E5Event", charter_id)
+            if charter in self.nodes:
+                self.nodes[charter].pop('content_hash', None)
+                self.nodes[charter].pop('pipeline_version', None)
+            neighbours = set()
+            for key in list(self._adjacency.get(charter, ())):
+                neighbours.add(key[2] if key[0] == charter else key[0])
+                self._delete(key)
+            for neighbour in neighbours:
+                for key in list(self._adjacency.get(neighbour, ())):
+                    charters = self.relationships[key]
+                    if charter_id in charters:
+                        charters.discard(charter_id)
+                        if not charters:
+                            self._delete(key)
+            for neighbour in neighbours:
+                if not self._adjacency.get(neighbour):
+                    self._adjacency.pop(neighbour, None)
+                    self.nodes.pop(neighbour, None)
+
+    def _delete(self, key):
+        del self.relationships[key]
+        self._adjacency[key[0]].discard(key)
+        self._adjacency[key[2]].discard(key)
+
+
+class LocalGraph:
+
+    def __init__(self, path=':memory:'):
+        """
+        :param path: the SQLite file, ':memory:' keeps the graph in memory
+        """
+        self.path = path
+        # a single connection shared by all threads, e.g. the writer threads of the Pipeline
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.models = LocalModels(self)
+        with self._lock, self._connection:
+            # the write-ahead log doesn't sync the file on every commit of a single save or connect
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS nodes ("
+                                     "id INTEGER PRIMARY KEY, label TEXT NOT NULL, name TEXT NOT NULL, "
+                                     "props TEXT NOT NULL, UNIQUE (label, name))")
+            # the relationships of a node are found by the primary key or the dst index. charters is NULL for
+            # relationships which weren't written by the GraphWriter, like r.charters in neo4j.
+            self._connection.execute("CREATE TABLE IF NOT EXISTS relationships ("
+                                     "src INTEGER NOT NULL, type TEXT NOT NULL, dst INTEGER NOT NULL, charters TEXT, "
+                                     "PRIMARY KEY (src, type, dst))")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS relationships_dst ON relationships (dst, type, src)")
+
+    def write(self, nodes, relationships):
+        """
+        Merge a batch of nodes and relationships, see Neo4jStore.write
+
+        :param nodes: dict of crm class -> list of {'name': ..., 'props': {...}} rows
+        :param relationships: dict of (source crm class, relationship type, target crm class) -> list of
+            {'src': ..., 'dst': ..., 'charters': [...]} rows
+        :return:
+        """
+        with self._lock, self._connection:
+            for label, rows in nodes.items():
+                for row in rows:
+                    self._merge_node(label, row['name'], row['props'])
+            for (src_label, rel_type, dst_label), rows in relationships.items():
+                for row in rows:
+                    src, dst = self._node_id(src_label, row['src']), self._node_id(dst_label, row['dst'])
+                    # relationships are only created between existing nodes, like MATCH ... MERGE
+                    if src is None or dst is None:
+                        continue
+                    self._merge_relationship(src, rel_type, dst, row['charters'])
+
+    def charter_state(self, charter_ids):
+        """
+        Return content hash and pipeline version of charters that were already written
+
+        :param charter_ids: list of charter ids
+        :return: dict of charter id -> (content hash, pipeline version)
+        """
+        state = {}
+        with self._lock:
+            for start in range(0, len(charter_ids), IN_LIMIT):
+                chunk = list(charter_ids[start:start + IN_LIMIT])
+                rows = self._connection.execute("SELECT name, props FROM nodes WHERE label = 'E5Event' AND name IN "
+                                                "({0})".format(', '.join('?' * len(chunk))), chunk)
+                for name, props in rows:
+                    props = json.loads(props)
+                    state[name] = (props.get('content_hash'), props.get('pipeline_version'))
+        return state
+
+    def retract(self, charter_ids):
+        """
+        Remove the statements of charters, see Neo4jStore.retract
+
+        :param charter_ids: list of charter ids
+        :return:
+        """
+        with self._lock, self._connection:
+            for charter_id in charter_ids:
+                found = self._find("E5Event", charter_id)
+                if found is None:
+                    continue
+                charter, props = found
+                props.pop('content_hash', None)
+                props.pop('pipeline_version', None)
+                self._connection.execute("UPDATE nodes SET props = ? WHERE id = ?",
+                                         (json.dumps(props, sort_keys=True), charter))
+                neighbours = set(other for _, _, other, _ in self._relationships(charter))
+                for neighbour in neighbours:
+                    for src, rel_type, dst, charters in self._relationships(neighbour, oriented=True):
+                        if charters is None or src == charter or dst == charter:
+                            continue
+                        charters = json.loads(charters)
+                        if charter_id in charters:
+                            charters.remove(charter_id)
+                            self._update_charters(src, rel_type, dst, charters)
+                self._connection.execute("DELETE FROM relationships WHERE src = ? OR dst = ?", (charter, charter))
+                for neighbour in neighbours:
+                    if not self._relationships(neighbour):
+                        self._connection.execute("DELETE FROM nodes WHERE id = ?", (neighbour,))
+
+    def clear(self):
+        """
+        Delete all nodes and relationships
+
+        :return:
+        """
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM relationships")
+            self._connection.execute("DELETE FROM nodes")
+
+    def close(self):
+        """
+        Close the SQLite file
+
+        :return:
+        """
+        with self._lock:
+            self._connection.close()
+
+    def count(self):
+        """
+        :return: number of nodes and number of relationships
+        """
+        with self._lock:
+            nodes = self._connection.execute("SELECT count(*) FROM nodes").fetchone()[0]
+            relationships = self._connection.execute("SELECT count(*) FROM relationships").fetchone()[0]
+        return nodes, relationships
+
+    def find(self, label, name):
+        """
+        :param label: the crm class
+        :param name: the node name
+        :return: id and properties of the node, None if there is no such node
+        """
+        with self._lock:
+            return self._find(label, name)
+
+    def save(self, label, name, props):
+        """
+        Create a node or add properties to the existing node with the same crm class and name
+
+        :param label: the crm class
+        :param name: the node name
+        :param props: the properties of the node
+        :return: the id of the node
+        """
+        with self._lock, self._connection:
+            return self._merge_node(label, name, props)
+
+    def connect(self, src, rel_type, dst):
+        """
+        Create a relationship between two nodes unless it already exists
+
+        :param src: id of the source node
+        :param rel_type: the relationship type
+        :param dst: id of the target node
+        :return:
+        """
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR IGNORE INTO relationships (src, type, dst) VALUES (?, ?, ?)",
+                                     (src, rel_type, dst))
+
+    def is_connected(self, src, rel_type, dst):
+        """
+        :param src: id of the source node
+        :param rel_type: the relationship type
+        :param dst: id of the target node
+        :return: whether the relationship exists
+        """
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM relationships WHERE src = ? AND type = ? AND dst = ?",
+                                            (src, rel_type, dst)).fetchone() is not None
+
+    def _find(self, label, name):
+        row = self._connection.execute("SELECT id, props FROM nodes WHERE label = ? AND name = ?",
+                                       (label, name)).fetchone()
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def _merge_node(self, label, name, props):
+        row = self._connection.execute("SELECT id, props FROM nodes WHERE label = ? AND name = ?",
+                                       (label, name)).fetchone()
+        if row is None:
+            return self._connection.execute("INSERT INTO nodes (label, name, props) VALUES (?, ?, ?)",
+                                            (label, name, json.dumps(props, sort_keys=True))).lastrowid
+        node_id, existing = row
+        if props:
+            existing = json.loads(existing)
+            existing.update(props)
+            self._connection.execute("UPDATE nodes SET props = ? WHERE id = ?",
+                                     (json.dumps(existing, sort_keys=True), node_id))
+        return node_id
+
+    def _merge_relationship(self, src, rel_type, dst, charters):
+        row = self._connection.execute("SELECT charters FROM relationships WHERE src = ? AND type = ? AND dst = ?",
+                                       (src, rel_type, dst)).fetchone()
+        if row is None:
+            self._connection.execute("INSERT INTO relationships (src, type, dst, charters) VALUES (?, ?, ?, ?)",
+                                     (src, rel_type, dst, json.dumps(list(charters))))
+            return
+        existing = json.loads(row[0]) if row[0] is not None else []
+        added = [charter_id for charter_id in charters if charter_id not in existing]
+        if added:
+            self._update_charters(src, rel_type, dst, existing + added)
+
+    def _update_charters(self, src, rel_type, dst, charters):
+        if charters:
+            self._connection.execute("UPDATE relationships SET charters = ? WHERE src = ? AND type = ? AND dst = ?",
+                                     (json.dumps(charters), src, rel_type, dst))
+        else:
+            self._connection.execute("DELETE FROM relationships WHERE src = ? AND type = ? AND dst = ?",
+                                     (src, rel_type, dst))
+
+    def _node_id(self, label, name):
+        row = self._connection.execute("SELECT id FROM nodes WHERE label = ? AND name = ?", (label, name)).fetchone()
+        return None if row is None else row[0]
+
+    def _relationships(self, node, oriented=False):
+        # (node, type, other node, charters) of the relationships of a node, or (src, type, dst, charters)
+        rows = self._connection.execute("SELECT src, type, dst, charters FROM relationships WHERE src = ? "
+                                        "UNION ALL "
+                                        "SELECT src, type, dst, charters FROM relationships WHERE dst = ? AND src <> ?",
+                                        (node, node, node)).fetchall()
+        if oriented:
+            return rows
+        return [(node, rel_type, dst if src == node else src, charters) for src, rel_type, dst, charters in rows]
+
+
+class LocalModels:
+    """
+    Stand-in for the crm models module, the crm classes are looked up as attributes: graph.models.E21Person
+    """
+
+    def __init__(self, graph):
+        self._graph = graph
+        self._models = {}
+
+    def __getattr__(self, label):
+        if label.startswith('_'):
+            raise AttributeError(label)
+        if label not in self._models:
+            # raises AttributeError for unknown crm classes
+            getattr(models, label)
+            self._models[label] = LocalModel(self._graph, label)
+        return self._models[label]
+
+
+class LocalModel:
+    """
+    Stand-in for a crm class: LocalModel(name=...) creates a node, LocalModel.nodes looks nodes up
+    """
+
+    def __init__(self, graph, label):
+        self.graph = graph
+        self.label = label
+        self.nodes = LocalNodeSet(self)
+
+    def __call__(self, **props):
+        return LocalNode(self, props)
+
+
+class LocalNodeSet:
+
+    def __init__(self, model):
+        self.model = model
+
+    def get_or_none(self, **filters):
+        """
+        Look up a node by name, further properties are compared after the lookup
+
+        :param filters: the name of the node and optionally further properties
+        :return: the node, None if there is no such node
+        """
+        if 'name' not in filters:
+            raise ValueError('nodes of the local graph are looked up by name')
+        found = self.model.graph.find(self.model.label, filters['name'])
+        if found is None:
+            return None
+        node_id, props = found
+        props['name'] = filters['name']
+        if any(props.get(key) != value for key, value in filters.items()):
+            return None
+        node = LocalNode(self.model, props)
+        node.id = node_id
+        return node
+
+
+class LocalNode:
+    """
+    Stand-in for a neomodel node, the properties are attributes and the crm properties relationship managers
+    """
+
+    def __init__(self, model, props):
+        self._model = model
+        self.id = None
+        for key, value in props.items():
+            setattr(self, key, value)
+
+    def __getattr__(self, prop):
+        # only called for attributes which aren't properties of the node
+        if prop.startswith('_'):
+            raise AttributeError(prop)
+        # unset properties are None, like in neomodel
+        if prop in getattr(models, self._model.label).defined_properties(aliases=False, rels=False):
+            return None
+        try:
+            rel_type, direction = relationship_type(self._model.label, prop)
+        except AttributeError:
+            raise AttributeError("{0} has no property or relationship '{1}'".format(self._model.label, prop))
+        return LocalRelationship(self, rel_type, direction)
+
+    def __eq__(self, other):
+        return isinstance(other, LocalNode) and self.id is not None and self.id == other.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def save(self):
+        """
+        Write the node to the local graph
+
+        :return: the node
+        """
+        props = dict((key, value) for key, value in vars(self).items()
+                     if not key.startswith('_') and key not in ('id', 'name') and value is not None)
+        self.id = self._model.graph.save(self._model.label, self.name, props)
+        return self
+
+
+class LocalRelationship:
+    """
+    Stand-in for the neomodel relationship manager of a crm property
+    """
+
+    def __init__(self, node, rel_type, direction):
+        self.node = node
+        self.rel_type = rel_type
+        self.direction = direction
+
+    def connect(self, other):
+        """
+        Connect the node to another node, nothing happens if they are already connected
+
+        :param other: the other node
+        :return:
+        """
+        src, dst = self._ends(other)
+        self.node._model.graph.connect(src, self.rel_type, dst)
+
+    def is_connected(self, other):
+        """
+        :param other: the other node
+        :return: whether the nodes are connected
+        """
+        src, dst = self._ends(other)
+        graph = self.node._model.graph
+        if self.direction == EITHER:
+            return graph.is_connected(src, self.rel_type, dst) or graph.is_connected(dst, self.rel_type, src)
+        return graph.is_connected(src, self.rel_type, dst)
+
+    def _ends(self, other):
+        if self.node.id is None or other.id is None:
+            raise ValueError("can't connect unsaved nodes, call save() first")
+        if self.direction == INCOMING:
+            return other.id, self.node.id
+        return self.node.id, other.id
+
+
+def open_graph(backend, path=None):
+    """
+    Open the graph backend set in config.json
+
+    :param backend: 'neo4j', 'sqlite' or 'memory'
+    :param path: the SQLite file of the 'sqlite' backend
+    :return: the LocalGraph, None for neo4j
+    """
+    if backend == 'neo4j':
+        return None
+    if backend == 'sqlite':
+        return LocalGraph(path)
+    if backend == 'memory':
+        return LocalGraph()
+    raise ValueError("unknown graph backend '{0}', use 'neo4j', 'sqlite' or 'memory'".format(backend))
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Metrics of the ingestion path.
+
+The MetricsRegistry collects, per stage of the ingestion path:
+
+ - timers: number of calls, documents, wall time and the slowest calls with the charter or abstract they processed
+ - counters: neo4j round trips (every db.cypher_query of any thread, counted for the innermost running stage of the
+   calling thread) and the split of
+   the extraction results into quadruples, triples, subject/verb pairs and failed extractions
+ - gauges: values sampled when a snapshot is taken, e.g. the hits and misses of the caches
+
+instrument() wraps the functions of the ingestion path, nothing is measured unless it is called:
+
+    metrics = MetricsRegistry()
+    metrics.instrument(nlp=nlp, module=examples, writer=writer)
+    metrics.start_reporter(60)
+    ...
+    metrics.dump('metrics.json')
+"""
+from __future__ import unicode_literals
+from contextlib import contextmanager
+from neomodel import db
+import functools
+import heapq
+import json
+import threading
+import time
+
+# kinds of extraction results by length, the empty string of a failed extraction has length 0
+EXTRACTION_KINDS = {4: 'quadruples', 3: 'triples', 2: 'pairs'}
+
+
+class Timer:
+
+    def __init__(self, slowest=10):
+        """
+        :param slowest: number of slowest calls kept
+        """
+        self.calls = 0
+        self.docs = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.keep = slowest
+        # heap of (duration, label) tuples
+        self.slowest = []
+
+    def record(self, duration, docs=1, label=None):
+        self.calls += 1
+        self.docs += docs
+        self.total += duration
+        self.max = max(self.max, duration)
+        if label is not None:
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, (duration, label))
+            elif duration > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (duration, label))
+
+    def summary(self):
+        """
+        :return: dict with calls, docs, total and mean time per doc and the slowest calls
+        """
+        return {
+            'calls': self.calls,
+            'docs': self.docs,
+            'total_s': self.total,
+            'ms_per_doc': self.total / self.docs * 1000 if self.docs else 0.0,
+            'max_ms': self.max * 1000,
+            'slowest': [{'ms': duration * 1000, 'label': label} for duration, label in sorted(self.slowest,
+                                                                                             reverse=True)],
+        }
+
+
+class MetricsRegistry:
+
+    def __init__(self, slowest=10):
+        """
+        :param slowest: number of slowest calls kept per stage
+        """
+        self.slowest = slowest
+        self.timers = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+        # stack of the running stages of a thread
+        self._local = threading.local()
+        # (object, attribute name, original attribute) of the instrumented functions
+        self._patched = []
+        self._reporter = None
+
+    def count(self, name, value=1):
+        """
+        Increase a counter
+
+        :param name: the name of the counter
+        :param value: the increment
+        :return:
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, function):
+        """
+        Register a gauge
+
+        :param name: the name of the gauge
+        :param function: function returning the current value
+        :return:
+        """
+        self.gauges[name] = function
+
+    @contextmanager
+    def time(self, stage, docs=1, label=None):
+        """
+        Time a block of code as a stage
+
+        :param stage: the name of the stage, e.g. 'parse'
+        :param docs: number of documents processed by the block
+        :param label: optional label of the block, e.g. the charter id, reported for the slowest calls
+        :return:
+        """
+        stack = self._stack()
+        stack.append(stage)
+        start = time.time()
+        try:
+            yield
+        finally:
+            stack.pop()
+            self.record(stage, time.time() - start, docs, label)
+
+    def record(self, stage, duration, docs=1, label=None):
+        """
+        Record a call of a stage that was timed elsewhere
+
+        :param stage: the name of the stage, e.g. 'parse'
+        :param duration: the wall time in seconds
+        :param docs: number of documents processed
+        :param label: optional label of the call, e.g. the charter id, reported for the slowest calls
+        :return:
+        """
+        with self._lock:
+            if stage not in self.timers:
+                self.timers[stage] = Timer(self.slowest)
+            self.timers[stage].record(duration, docs, label)
+
+    def stage(self):
+        """
+        :return: the innermost running stage of the current thread, None outside of stages
+        """
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def snapshot(self):
+        """
+        :return: dict with the current values of all timers, counters and gauges
+        """
+        with self._lock:
+            timers = dict((stage, timer.summary()) for stage, timer in self.timers.items())
+            counters = dict(self.counters)
+        gauges = {}
+        for name, function in self.gauges.items():
+            try:
+                gauges[name] = function()
+            except Exception as e:
+                gauges[name] = 'error: {0}'.format(e)
+        return {'uptime_s': time.time() - self.started, 'timers': timers, 'counters': counters, 'gauges': gauges}
+
+    def summary(self):
+        """
+        :return: a short human-readable summary of the snapshot
+        """
+        snapshot = self.snapshot()
+        lines = ['metrics after {0:.0f}s'.format(snapshot['uptime_s'])]
+        for stage, timer in sorted(snapshot['timers'].items()):
+            line = '  {0:<10} {1:>8} docs {2:>9.2f}s {3:>8.2f}ms/doc'.format(stage, timer['docs'], timer['total_s'],
+                                                                             timer['ms_per_doc'])
+            round_trips = snapshot['counters'].get('neo4j.round_trips.{0}'.format(stage))
+            if round_trips:
+                line += ' {0:>8} round trips'.format(round_trips)
+            if timer['slowest']:
+                line += ', slowest {0:.1f}ms ({1})'.format(timer['slowest'][0]['ms'], timer['slowest'][0]['label'])
+            lines.append(line)
+        for name, value in sorted(snapshot['counters'].items()):
+            if not name.startswith('neo4j.round_trips.') or name == 'neo4j.round_trips.other':
+                lines.append('  {0}: {1}'.format(name, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append('  {0}: {1}'.format(name, value))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """
+        Write the snapshot to a JSON file
+
+        :param path: the JSON file
+        :return:
+        """
+        with open(path, 'w') as dump_file:
+            json.dump(self.snapshot(), dump_file, indent=2, sort_keys=True)
+
+    def start_reporter(self, interval=60.0, report=None):
+        """
+        Print the summary periodically in a background thread
+
+        :param interval: seconds between two summaries
+        :param report: function called with the summary (default: print)
+        :return:
+        """
+        if self._reporter is not None:
+            return
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                (report or _print)(self.summary())
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self._reporter = (thread, stop)
+
+    def stop_reporter(self):
+        """
+        Stop the periodic summaries
+
+        :return:
+        """
+        if self._reporter is not None:
+            thread, stop = self._reporter
+            stop.set()
+            thread.join()
+            self._reporter = None
+
+    def instrument(self, nlp=None, module=None, writer=None, entity_cache=None, parse_cache=None):
+        """
+        Wrap the functions of the ingestion path, all arguments are optional
+
+        :param nlp: the NLP pipeline, spacy_dependency_parse, pipe_dependency_parse (used by extract) and
+            analyze_deps (used by analyze_dep and extract) are timed and the extraction results are counted
+        :param module: the examples module, do_nlp and create_crm_entity_with_name are timed
+        :param writer: a GraphWriter, flush is timed
+        :param entity_cache: an EntityCache, its hits and misses are reported
+        :param parse_cache: a ParseCache, its hits and misses are reported
+        :return:
+        """
+        # every query of neomodel and the graph stores goes through db.cypher_query. db is thread-local, so its
+        # class is patched to count the queries of all threads, e.g. of the writer threads of the Pipeline
+        if not any(obj is type(db) for obj, _, _ in self._patched):
+            self._patch(type(db), 'cypher_query', self._count_round_trips)
+        if nlp is not None:
+            self._patch(nlp, 'spacy_dependency_parse', self._timed('parse', label=lambda args: args[0][:60]))
+            self._patch(nlp, 'pipe_dependency_parse', self._piped(nlp))
+            self._patch(nlp, 'analyze_deps', self._analyzed)
+            self.gauge('nlp.parsed', lambda: nlp.parsed)
+            self.gauge('nlp.parse_time_s', lambda: nlp.parse_time)
+            if nlp.fast_path is not None:
+                self.gauge('fast_path.hits', lambda: nlp.fast_path.hits)
+                self.gauge('fast_path.misses', lambda: nlp.fast_path.misses)
+        if module is not None:
+            self._patch(module, 'do_nlp', self._timed('do_nlp', label=lambda args: args[2]))
+            self._patch(module, 'create_crm_entity_with_name',
+                        self._timed('entity', label=lambda args: '{0} {1}'.format(*args)))
+        if writer is not None:
+            self._patch(writer, 'flush', self._timed('write', docs=lambda args: len(writer.staging)))
+        for name, cache in (('entity_cache', entity_cache), ('parse_cache', parse_cache)):
+            if cache is not None:
+                self.gauge(name + '.hits', lambda cache=cache: cache.hits)
+                self.gauge(name + '.misses', lambda cache=cache: cache.misses)
+
+    def uninstrument(self):
+        """
+        Restore the functions wrapped by instrument
+
+        :return:
+        """
+        for obj, name, original in reversed(self._patched):
+            if original is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, original)
+        self._patched = []
+
+    def _patch(self, obj, name, wrapper):
+        function = getattr(obj, name)
+        # instance attributes are restored, methods looked up on the class are unshadowed
+        self._patched.append((obj, name, vars(obj).get(name)))
+        setattr(obj, name, functools.wraps(function)(wrapper(function)))
+
+    def _timed(self, stage, docs=None, label=None):
+        def wrapper(function):
+            def timed(*args, **kwargs):
+                with self.time(stage, docs(args) if docs else 1, label(args) if label else None):
+                    return function(*args, **kwargs)
+            return timed
+        return wrapper
+
+    def _piped(self, nlp):
+        def wrapper(function):
+            def piped(*args, **kwargs):
+                parse_time = nlp.parse_time
+                for doc, charter_id in function(*args, **kwargs):
+                    # the parse time of the nlp excludes the time spent reading the abstracts and handling the docs
+                    self.record('parse', nlp.parse_time - parse_time, label=doc.text[:60])
+                    parse_time = nlp.parse_time
+                    yield doc, charter_id
+            return piped
+        return wrapper
+
+    def _analyzed(self, function):
+        def analyzed(docs):
+            docs = list(docs)
+            with self.time('analyze', len(docs)):
+                results = function(docs)
+            for dep_data in results:
+                self.count('extraction.{0}'.format(EXTRACTION_KINDS.get(len(dep_data), 'failed')))
+            return results
+        return analyzed
+
+    def _count_round_trips(self, function):
+        def cypher_query(*args, **kwargs):
+            self.count('neo4j.round_trips.{0}'.format(self.stage() or 'other'))
+            return function(*args, **kwargs)
+        return cypher_query
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+
+def _print(summary):
+    print(summary)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Precompiled cache of the CRM model.
+
+models.build_models parses the CIDOC-CRM RDFS file and creates hundreds of neomodel classes on every start. This
+module runs build_models once, describes the resulting class and property hierarchy (bases, relationship
+definitions and node properties) as plain data and stores it as JSON. Later starts create the classes directly from
+that description, which doesn't require parsing the schema file.
+
+The cache file is keyed by a hash of the schema file and of the node fields, so it is rebuilt automatically when
+either of them changes.
+"""
+from __future__ import unicode_literals
+from crm import models
+from importlib import import_module
+from neomodel import (Property, Relationship, RelationshipFrom, RelationshipTo)
+from neomodel.relationship_manager import (INCOMING, OUTGOING, RelationshipDefinition)
+import hashlib
+import json
+import os
+
+# version of the cache format, bump it if describe_models changes
+CACHE_VERSION = 1
+
+# constructor arguments shared by all neomodel properties
+PROPERTY_ARGS = ('unique_index', 'index', 'required', 'default', 'db_property', 'label', 'help_text')
+
+
+def load_models(schema_file, fields, cache_dir):
+    """
+    Load the crm model from the model cache or build and cache it from the crm model file
+
+    :param schema_file: the CIDOC-CRM RDFS file
+    :param fields: the node fields passed to models.build_models
+    :param cache_dir: the cache directory
+    :return: the path of the cache file
+    """
+    path = os.path.join(cache_dir, 'crm-{0}.json'.format(cache_key(schema_file, fields)))
+    if os.path.exists(path):
+        with open(path) as cache_file:
+            create_models(json.load(cache_file), fields)
+        return path
+
+    existing = set(vars(models))
+    models.build_models(schema_file, fields=fields)
+    description = describe_models(set(vars(models)) - existing, fields)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # replace the cache file atomically, so concurrent starts never read a partial file
+    with open(path + '.tmp', 'w') as cache_file:
+        json.dump(description, cache_file)
+    os.rename(path + '.tmp', path)
+    return path
+
+
+def cache_key(schema_file, fields):
+    """
+    Hash the schema file and the signature of the node fields
+
+    :param schema_file: the CIDOC-CRM RDFS file
+    :param fields: the node fields passed to models.build_models
+    :return: the hex digest
+    """
+    key = hashlib.sha1()
+    key.update(str(CACHE_VERSION).encode('utf-8'))
+    with open(schema_file, 'rb') as schema:
+        key.update(schema.read())
+    for name in sorted(fields):
+        prop = fields[name]()
+        args = sorted((arg, repr(getattr(prop, arg, None))) for arg in PROPERTY_ARGS)
+        key.update('{0}:{1}:{2}'.format(name, type(prop).__name__, args).encode('utf-8'))
+    return key.hexdigest()
+
+
+def describe_models(names, fields):
+    """
+    Describe the crm classes created by models.build_models as plain data
+
+    :param names: the names of the classes created by models.build_models
+    :param fields: the node fields passed to models.build_models
+    :return: list of class descriptions, base classes first
+    """
+    description = []
+    done = set()
+
+    def describe(cls):
+        if cls.__name__ in done:
+            return
+        done.add(cls.__name__)
+        for base in cls.__bases__:
+            if base.__name__ in names:
+                describe(base)
+        for value in vars(cls).values():
+            if isinstance(value, RelationshipDefinition) and value.definition.get('model') is not None:
+                if value.definition['model'].__name__ in names:
+                    describe(value.definition['model'])
+        attrs = {'relationships': [], 'properties': [], 'fields': []}
+        for attr, value in sorted(vars(cls).items()):
+            if isinstance(value, RelationshipDefinition):
+                target = value._raw_class if isinstance(value._raw_class, basestring) else value._raw_class.__name__
+                model = value.definition.get('model')
+                attrs['relationships'].append({
+                    'attr': attr,
+                    'relation_type': value.definition['relation_type'],
+                    'direction': value.definition['direction'],
+                    'target': target.split('.')[-1],
+                    'manager': _path(value.manager),
+                    'model': _path(model) if model is not None else None,
+                })
+            elif isinstance(value, Property) and attr in fields:
+                attrs['fields'].append(attr)
+            elif isinstance(value, Property):
+                attrs['properties'].append({
+                    'attr': attr,
+                    'class': _path(type(value)),
+                    'args': dict((arg, getattr(value, arg)) for arg in PROPERTY_ARGS
+                                 if isinstance(getattr(value, arg, None), (basestring, bool, int, float))),
+                })
+        attrs.update({
+            'name': cls.__name__,
+            'bases': [base.__name__ if base.__name__ in names else _path(base) for base in cls.__bases__],
+            'label': vars(cls).get('__label__'),
+            'doc': cls.__doc__,
+        })
+        description.append(attrs)
+
+    for name in sorted(names):
+        value = getattr(models, name)
+        if isinstance(value, type):
+            describe(value)
+    return description
+
+
+def create_models(description, fields):
+    """
+    Create the crm classes from their description and add them to the crm models module
+
+    :param description: the class descriptions returned by describe_models
+    :param fields: the node fields passed to models.build_models
+    :return:
+    """
+    factories = {OUTGOING: RelationshipTo, INCOMING: RelationshipFrom}
+    for attrs in description:
+        bases = tuple(getattr(models, base) if '.' not in base else _resolve(base) for base in attrs['bases'])
+        namespace = {str('__module__'): models.__name__, str('__doc__'): attrs['doc']}
+        if attrs['label'] is not None:
+            namespace[str('__label__')] = attrs['label']
+        for rel in attrs['relationships']:
+            factory = factories.get(rel['direction'], Relationship)
+            # neomodel resolves dotted class names lazily, so the target doesn't need to exist yet
+            namespace[str(rel['attr'])] = factory(models.__name__ + '.' + rel['target'], rel['relation_type'],
+                                                  cardinality=_resolve(rel['manager']),
+                                                  model=_resolve(rel['model']) if rel['model'] else None)
+        for prop in attrs['properties']:
+            namespace[str(prop['attr'])] = _resolve(prop['class'])(**dict((str(arg), value) for arg, value
+                                                                          in prop['args'].items()))
+        for field in attrs['fields']:
+            namespace[str(field)] = fields[field]()
+        setattr(models, str(attrs['name']), type(str(attrs['name']), bases, namespace))
+
+
+def _path(cls):
+    return '{0}.{1}'.format(cls.__module__, cls.__name__)
+
+
+def _resolve(path):
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)
@@ -37,19 +37,264 @@ https://www.nltk.org/book/ch07.html#sec-relextract
 
 """
 from __future__ import unicode_literals
+from aliases import default_index
+from fast_path import (TemplateMatcher, TEMPLATE_VERSION)
 import spacy
-from spacy.attrs import intify_attrs
+from spacy.attrs import (DEP, HEAD, intify_attrs, ORTH, POS)
+from spacy.symbols import (NOUN, PROPN, VERB)
+import numpy
+import os
+import pkg_resources
 import sys
+import time
 
 reload(sys)
 sys.setdefaultencoding('utf8')
 
+# version of the extraction heuristic, bump it whenever analyze_dep produces different results
+HEURISTIC_VERSION = 2
+
+# pipeline components needed by the extraction, they set pos_, lemma_, dep_, head, children and doc.ents
+# (spaCy v2 models only have tagger, parser and ner, the other names are used by spaCy v3 models)
+COMPONENTS = ['tok2vec', 'tagger', 'morphologizer', 'attribute_ruler', 'lemmatizer', 'parser', 'ner']
+
+
+class RelationExtractor:
+    """
+    Array-based implementation of the heuristic of NLP.analyze_dep.
+
+    The tokens of a whole batch of docs are exported with doc.to_array into a single integer array. Dependency labels
+    and prepositions are compared as string ids against lookup tables compiled once, so apart from assembling the
+    results no Python code runs per token.
+
+    The heuristic looks at the tokens labelled 'sb', 'oa', 'da' or 'mnr', in the order they appear in a doc:
+     - the 1st one is the subject if it is labelled 'sb', its head is the verb
+     - the 2nd one is the direct object if it is labelled 'da' or 'oa' and its head is a verb
+     - the 3rd one is the indirect object if it is labelled 'oa'
+     - the first of the following 'mnr' tokens attached to a token with the text of the indirect object, that has a
+       noun child and is one of the prepositions below, makes the indirect object a place or a right
+    """
+
+    # these dependency labels are used to find subjects and objects
+    LABELS = ('sb', 'oa', 'da', 'mnr')
+    # these prepositions are used to check if a noun is a place
+    LOC_ATT = ('im', 'zu', 'gegenüber', 'in', 'neben', 'beim', 'bei', 'samt')
+    # these prepositions are used to analyse and determine a 'E30Right'
+    RIGHT_ATT = ('durch', 'auf', 'von', 'über', 'um')
+    ATTRS = [DEP, POS, HEAD, ORTH]
+
+    def __init__(self, strings, aliases=None):
+        """
+        :param strings: the string store of the docs
+        :param aliases: AliasIndex of actors and places (default: aliases.tsv)
+        """
+        self.aliases = aliases if aliases is not None else default_index()
+        self.sb, self.oa, self.da, self.mnr = [numpy.uint64(strings.add(label)) for label in self.LABELS]
+        self.labels = numpy.array([self.sb, self.oa, self.da, self.mnr], dtype=numpy.uint64)
+        self.objects = numpy.array([self.da, self.oa], dtype=numpy.uint64)
+        self.loc_att = numpy.array([strings.add(word) for word in self.LOC_ATT], dtype=numpy.uint64)
+        self.right_att = numpy.array([strings.add(word) for word in self.RIGHT_ATT], dtype=numpy.uint64)
+        self.nouns = numpy.array([NOUN, PROPN], dtype=numpy.uint64)
+
+    def canonical(self, name, label="E21Person"):
+        """
+        Force uniform spelling of actors and places like 'St. Katharinenspital', see AliasIndex
+
+        :param name: a subject or object
+        :param label: the crm class of the name
+        :return: the canonical name
+        """
+        return self.aliases.resolve(name, label)
+
+    def extract(self, docs, verbose=False):
+        """
+        Extract subject, verb, direct and indirect object of a batch of docs
+
+        :param docs: list of spaCy doc objects
+        :param verbose: print the analysed dependencies
+        :return: list of (subject, verb, dobject, dobject2) tuples, empty strings for missing parts
+        """
+        lengths = numpy.array([len(doc) for doc in docs], dtype=numpy.int64)
+        offsets = numpy.cumsum(lengths) - lengths
+        array = numpy.vstack([doc.to_array(self.ATTRS) for doc in docs])
+        deps, pos, orth = array[:, 0], array[:, 1], array[:, 3]
+        positions = numpy.arange(len(array))
+        # heads are stored relative to the token
+        heads = array[:, 2].astype(numpy.int64) + positions
+        doc_ids = numpy.repeat(numpy.arange(len(docs)), lengths)
+
+        # tokens with one of the labels and their rank within their doc
+        candidates = numpy.flatnonzero(numpy.isin(deps, self.labels))
+        ranks = numpy.arange(len(candidates)) - numpy.searchsorted(doc_ids[candidates], doc_ids[candidates])
+        labels = deps[candidates]
+        subjects = candidates[(ranks == 0) & (labels == self.sb)]
+        dobjects = candidates[(ranks == 1) & numpy.isin(labels, self.objects)]
+        dobjects = dobjects[pos[heads[dobjects]] == VERB]
+        dobjects2 = candidates[(ranks == 2) & (labels == self.oa)]
+
+        # modifiers attached to a token with the text of the indirect object
+        dobject2_of_doc = numpy.full(len(docs), -1, dtype=numpy.int64)
+        dobject2_of_doc[doc_ids[dobjects2]] = dobjects2
+        modifiers = candidates[(ranks > 2) & (labels == self.mnr)]
+        modifiers = modifiers[dobject2_of_doc[doc_ids[modifiers]] >= 0]
+        modifiers = modifiers[orth[heads[modifiers]] == orth[dobject2_of_doc[doc_ids[modifiers]]]]
+        modifiers = modifiers[numpy.isin(orth[modifiers], self.loc_att) | numpy.isin(orth[modifiers], self.right_att)]
+        # first noun child of every token
+        nouns = numpy.flatnonzero(numpy.isin(pos, self.nouns) & (heads != positions))
+        noun_heads, first_nouns = numpy.unique(heads[nouns], return_index=True)
+        slots = numpy.minimum(numpy.searchsorted(noun_heads, modifiers), max(len(noun_heads) - 1, 0))
+        modifiers = modifiers[noun_heads[slots] == modifiers] if len(noun_heads) else modifiers[:0]
+        # only the first matching modifier of a doc counts
+        modifiers = modifiers[numpy.unique(doc_ids[modifiers], return_index=True)[1]]
+        children = nouns[first_nouns[numpy.searchsorted(noun_heads, modifiers)]]
+
+        def token(i):
+            return docs[doc_ids[i]][i - offsets[doc_ids[i]]]
+
+        if verbose:
+            for candidate, rank in zip(candidates, ranks):
+                print(rank, token(candidate).dep_, token(candidate).head.pos_)
+
+        results = [['', '', '', ''] for _ in docs]
+        for i in subjects:
+            result = results[doc_ids[i]]
+            result[0] = self.canonical(token(i).text)
+            if pos[heads[i]] == VERB:
+                # manually fix a lemmatization problem
+                lemma = token(i).head.lemma_
+                result[1] = "verstiften" if lemma == "verstiftet" else lemma
+        for i in dobjects:
+            result = results[doc_ids[i]]
+            result[2] = self.canonical(token(i).text)
+            # resolve reflexive pronoun
+            if result[2] == "sich":
+                result[2] = result[0]
+        for i in dobjects2:
+            results[doc_ids[i]][3] = token(i).text
+        for i, child in zip(modifiers, children):
+            result = results[doc_ids[i]]
+            if orth[i] in self.loc_att:
+                result[3] = (result[3], token(child).lemma_)
+            else:
+                result[3] = ("E30Right", result[3])
+        for result in results:
+            # indirect objects which aren't rights are places
+            if isinstance(result[3], tuple):
+                if result[3][0] != "E30Right":
+                    result[3] = tuple(self.canonical(place, "E53Place") for place in result[3])
+            else:
+                result[3] = self.canonical(result[3], "E53Place")
+        return [tuple(result) for result in results]
+
 
 class NLP:
 
-    def __init__(self):
-        self.nlp = spacy.load('de_core_news_sm')
+    def __init__(self, model='de_core_news_sm', components=None, lazy=True, verbose=False, fast_path=False,
+                 aliases=None):
+        """
+        :param model: name or path of the spaCy language model
+        :param components: pipeline components to load, all other components of the model are disabled
+        :param lazy: load the language model on first use instead of now
+        :param verbose: print the analysed dependencies
+        :param fast_path: analyse formulaic abstracts with the TemplateMatcher instead of parsing them, see extract
+        :param aliases: AliasIndex used to canonicalise actors and places (default: aliases.tsv)
+        """
+        self.model = model
+        self.components = components if components is not None else COMPONENTS
+        self.verbose = verbose
+        self.aliases = aliases if aliases is not None else default_index()
+        self.fast_path = TemplateMatcher() if fast_path else None
+        self._nlp = None
+        self._extractor = None
+        self.load_time = None
+        self.parse_time = 0.0
+        self.parsed = 0
+        if not lazy:
+            # load the language model now
+            self.nlp
+
+    @property
+    def nlp(self):
+        # the language model is loaded on first use, so cached docs can be analysed without loading the parser
+        if self._nlp is None:
+            start = time.time()
+            self._nlp = spacy.load(self.model, disable=self.disabled_components())
+            self.load_time = time.time() - start
+        return self._nlp
 
+    def disabled_components(self):
+        """
+        Return the components of the language model which are not needed by the extraction. The model's meta data
+        is read without loading the model.
+
+        :return: list of component names
+        """
+        try:
+            pipeline = self.model_meta().get('pipeline', [])
+        except (IOError, OSError, ValueError):
+            return []
+        # the meta data of spaCy v2 models lists names, spaCy v1 models list dicts
+        names = [component if isinstance(component, basestring) else component['name'] for component in pipeline]
+        return [name for name in names if name not in self.components]
+
+    def model_meta(self):
+        """
+        Read the meta data of the language model without loading the model
+
+        :return: dict of the model's meta.json
+        """
+        if spacy.util.is_package(self.model):
+            path = spacy.util.get_package_path(self.model)
+        else:
+            path = spacy.util.ensure_path(self.model)
+        return spacy.util.get_model_meta(path)
+
+    def report(self):
+        """
+        Report the load time of the language model and the average latency per parsed document
+
+        :return: the report
+        """
+        if self.load_time is None:
+            report = 'language model {0} not loaded'.format(self.model)
+        else:
+            latency = self.parse_time / self.parsed if self.parsed else 0.0
+            report = 'language model {0} loaded in {1:.2f}s (disabled: {2}), {3} docs parsed, {4:.1f}ms per doc'.format(
+                self.model, self.load_time, ', '.join(self.disabled_components()) or '-', self.parsed, latency * 1000)
+        if self.fast_path is not None:
+            report += ', fast path hit rate {0:.1%} ({1} of {2} abstracts)'.format(
+                self.fast_path.hit_rate(), self.fast_path.hits, self.fast_path.hits + self.fast_path.misses)
+        return report
+
+    @property
+    def model_key(self):
+        """
+        Name and version of the language model and its disabled components, e.g. 'de_core_news_sm-2.3.0' or
+        'de_core_news_sm-2.3.0-without-ner'. Model directories are named by the last part of their path, so the key
+        can be used as a directory name.
+        """
+        try:
+            version = pkg_resources.get_distribution(self.model).version
+        except (pkg_resources.DistributionNotFound, ValueError):
+            # a model directory, its meta data is read without loading the model
+            version = self.model_meta()['version']
+        key = '{0}-{1}'.format(os.path.basename(os.path.normpath(self.model)), version)
+        disabled = self.disabled_components()
+        if disabled:
+            key += '-without-' + '+'.join(sorted(disabled))
+        return key
+
+    @property
+    def pipeline_version(self):
+        """
+        Version of the extraction heuristic, the language model, the aliases and the templates of the fast path if
+        it is enabled, e.g. '2/de_core_news_sm-2.3.0/3f2a9c1e' or '2/de_core_news_sm-2.3.0/3f2a9c1e/fast-path-2'.
+        Charters written with another pipeline version are processed again by incremental ingestion.
+        """
+        version = '{0}/{1}/{2}'.format(HEURISTIC_VERSION, self.model_key, self.aliases.checksum)
+        if self.fast_path is not None:
+            version += '/fast-path-{0}'.format(TEMPLATE_VERSION)
+        return version
 
     def analyze_dep(self, doc):
         """
@@ -64,62 +309,98 @@ class NLP:
         :param doc: spaCy doc object
         :return: quadruple or triple
         """
-        subject = ''
-        verb = ''
-        dobject = ''
-        dobject2 = ''
-        index = 0
-        # these prepositions are used to check if a noun is a place
-        loc_att = ['im', 'zu', 'gegenüber', 'in', 'neben', 'beim', 'bei', 'samt']
-        # these prepositions are used to analyse and determine a 'E30Right'
-        right_att = ['durch', 'auf', 'von', 'über', 'um']
-        # iterate through every token
-        for token in doc:
-            # try to extract subject
-            if token.dep_ == "sb" or token.dep_ == "oa" or token.dep_ == "da" or token.dep_ == "mnr":
-                # get subject
-                if token.dep_ == "sb" and index == 0:
-                    subject = token.text
-                    # force uniform spelling of 'St. Katharinenspital'
-                    if subject == "Spital" or subject == "St.-Katharinenspital" or subject == "Katharinenspital":
-                        subject = "St. Katharinenspital"
-                # get verb of subject 'What does X?'
-                if token.dep_ == "sb" and index == 0 and token.head.pos_ == "VERB":
-                    # manually fix a lemmatization problem
-                    if token.head.lemma_ == "verstiftet":
-                        verb = "verstiften"
-                    else:
-                        verb = token.head.lemma_
-                # get direct object
-                print(index, token.dep_, token.head.pos_)
-                if index == 1 and (token.dep_ == "da" or token.dep_ == "oa") and token.head.pos_ == "VERB":
-                    dobject = token.text
-                    # force uniform spelling of 'St. Katharinenspital'
-                    if dobject == "Spital" or dobject == "St.-Katharinenspital" or dobject == "Katharinenspital":
-                        dobject = "St. Katharinenspital"
-                    # resolve reflexive pronoun
-                    if dobject == "sich":
-                        dobject = subject
-                # get indirect object
-                if index == 2 and token.dep_ == "oa":
-                    dobject2 = token.text
-                # check if indirect object is location or right
-                if token.dep_ == 'mnr' and token.head.text == dobject2:
-                    tree = [child.lemma_ for child in token.children if child.pos_ == 'NOUN' or child.pos_ == 'PROPN']
-                    if tree:
-                        if token.text in loc_att:
-                            dobject2 = (dobject2, tree[0])
-                        elif token.text in right_att:
-                            dobject2 = ("E30Right", dobject2)
-                index += 1
-        print(subject, verb, dobject, dobject2)
-        if subject != '' and verb != '' and dobject != '' and dobject2 != '':
-            return self.check_subject(subject, doc), verb, dobject, dobject2
-        if subject != '' and verb != '' and dobject:
-            return self.check_subject(subject, doc), verb, dobject
-        if subject != '' and verb != '':
-            return self.check_subject(subject, doc), verb
-        return ''
+        return self.analyze_deps([doc])[0]
+
+    def analyze_deps(self, docs):
+        """
+        Apply the heuristic of analyze_dep to a batch of docs at once, see RelationExtractor
+
+        :param docs: list of spaCy doc objects
+        :return: list of quadruples or triples
+        """
+        docs = list(docs)
+        if not docs:
+            return []
+        if self._extractor is None:
+            self._extractor = RelationExtractor(docs[0].vocab.strings, self.aliases)
+        results = []
+        for doc, (subject, verb, dobject, dobject2) in zip(docs, self._extractor.extract(docs, self.verbose)):
+            if self.verbose:
+                print(subject, verb, dobject, dobject2)
+            if subject != '' and verb != '' and dobject != '' and dobject2 != '':
+                results.append((self.check_subject(subject, doc), verb, dobject, dobject2))
+            elif subject != '' and verb != '' and dobject:
+                results.append((self.check_subject(subject, doc), verb, dobject))
+            elif subject != '' and verb != '':
+                results.append((self.check_subject(subject, doc), verb))
+            else:
+                results.append('')
+        return results
+
+    def extract(self, charter_abstracts, batch_size=64, n_process=1, cache=None):
+        """
+        Parse and analyse a stream of charter abstracts. If the fast path is enabled, abstracts following one of the
+        templates of the TemplateMatcher are annotated by the matcher and only the remaining abstracts are parsed.
+        Both are analysed by analyze_deps.
+
+        :param charter_abstracts: iterable of (charter abstract, charter id) tuples
+        :param batch_size: number of abstracts per batch
+        :param n_process: number of worker processes (-1 uses all cores)
+        :param cache: optional ParseCache
+        :return: generator of (spaCy doc object, quadruple or triple, charter id) tuples in input order
+        """
+        if self.fast_path is None:
+            if cache is None:
+                docs = self.pipe_dependency_parse(charter_abstracts, batch_size, n_process)
+            else:
+                docs = self.cached_dependency_parse(charter_abstracts, cache, batch_size, n_process)
+            for item in self.pipe_analyze_dep(docs, batch_size):
+                yield item
+            return
+
+        batch = []
+        for charter_abstract, charter_id in charter_abstracts:
+            batch.append((charter_abstract, charter_id))
+            if len(batch) >= batch_size:
+                for item in self._extract_batch(batch, batch_size, n_process, cache):
+                    yield item
+                batch = []
+        for item in self._extract_batch(batch, batch_size, n_process, cache):
+            yield item
+        if cache is not None:
+            cache.save()
+
+    def _extract_batch(self, batch, batch_size, n_process, cache):
+        matches = [self.fast_path.match(charter_abstract.decode('utf-8')) for charter_abstract, _ in batch]
+        docs = [doc for doc, _ in matches]
+        missing = [i for i, (_, matched) in enumerate(matches) if not matched]
+        if missing:
+            if cache is None:
+                parsed = self.pipe_dependency_parse([batch[i] for i in missing], batch_size, n_process)
+            else:
+                parsed = self._parse_batch([batch[i] for i in missing], cache, batch_size, n_process)
+            for i, (doc, _) in zip(missing, parsed):
+                docs[i] = doc
+        return [(doc, dep_data, charter_id) for doc, dep_data, (_, charter_id) in zip(docs, self.analyze_deps(docs),
+                                                                                     batch)]
+
+    def pipe_analyze_dep(self, docs, batch_size=256):
+        """
+        Apply analyze_deps to a stream of docs in batches
+
+        :param docs: iterable of (spaCy doc object, charter id) tuples, e.g. returned by pipe_dependency_parse
+        :param batch_size: number of docs analysed at once
+        :return: generator of (spaCy doc object, quadruple or triple, charter id) tuples in input order
+        """
+        batch = []
+        for doc, charter_id in docs:
+            batch.append((doc, charter_id))
+            if len(batch) >= batch_size:
+                for (doc, charter_id), dep_data in zip(batch, self.analyze_deps([doc for doc, _ in batch])):
+                    yield doc, dep_data, charter_id
+                batch = []
+        for (doc, charter_id), dep_data in zip(batch, self.analyze_deps([doc for doc, _ in batch])):
+            yield doc, dep_data, charter_id
 
     def check_subject(self, subject, doc):
         """
@@ -127,11 +408,11 @@ class NLP:
 
         :param subject: the subject of a sentence
         :param doc: the spaCy document object
-        :return: the new merged token
+        :return: the new merged token, in its canonical spelling
         """
         noun = subject
         if doc[1].pos_ == 'DET' and doc[2].pos_ == 'NOUN':
-            noun = doc[0].text + ' ' + doc[1].text + ' ' + doc[2].text
+            noun = self.aliases.resolve(doc[0].text + ' ' + doc[1].text + ' ' + doc[2].text, "E21Person")
         return noun
 
     def spacy_dependency_parse(self, charter_abstract):
@@ -151,7 +432,94 @@ class NLP:
         # Issues with spaCy German lemmatiser (1) https://github.com/explosion/spaCy/issues/2486
         # Issues with spaCy German lemmatiser (2) https://github.com/explosion/spaCy/issues/2668
 
-        doc = self.nlp(charter_abstract.decode('utf-8'))
+        nlp = self.nlp
+        start = time.time()
+        doc = self.merge_entities(nlp(charter_abstract.decode('utf-8')))
+        self.parse_time += time.time() - start
+        self.parsed += 1
+
+        return doc
+
+    def pipe_dependency_parse(self, charter_abstracts, batch_size=64, n_process=1):
+        """
+        Execute spaCy NLP pipeline for a stream of charter abstracts. The abstracts are buffered and processed in
+        batches by nlp.pipe, optionally spread over several worker processes. Each doc is retokenized the same way
+        as in spacy_dependency_parse.
+
+        See: https://spacy.io/usage/processing-pipelines#multiprocessing
+
+        :param charter_abstracts: iterable of (charter abstract, charter id) tuples
+        :param batch_size: number of abstracts per batch
+        :param n_process: number of worker processes (-1 uses all cores)
+        :return: generator of (spaCy doc object, charter id) tuples in input order
+        """
+        nlp = self.nlp
+        # seconds nlp.pipe spent waiting for the next abstract, e.g. reading sources or querying the graph store
+        upstream = [0.0]
+
+        def texts():
+            abstracts = iter(charter_abstracts)
+            while True:
+                start = time.time()
+                try:
+                    charter_abstract, charter_id = next(abstracts)
+                except StopIteration:
+                    return
+                finally:
+                    upstream[0] += time.time() - start
+                yield charter_abstract.decode('utf-8'), charter_id
+
+        # only the time spent in the pipeline counts, neither the time the consumer needs for a doc nor the time
+        # spent in the iterator of the abstracts
+        start = time.time()
+        for doc, charter_id in nlp.pipe(texts(), as_tuples=True, batch_size=batch_size, n_process=n_process):
+            doc = self.merge_entities(doc)
+            self.parse_time += time.time() - start - upstream[0]
+            self.parsed += 1
+            upstream[0] = 0.0
+            yield doc, charter_id
+            start = time.time()
+
+    def cached_dependency_parse(self, charter_abstracts, cache, batch_size=64, n_process=1):
+        """
+        Like pipe_dependency_parse, but docs are taken from a parse cache if the abstract was parsed before. Only
+        the remaining abstracts are parsed and added to the cache. If all abstracts are cached, the language model
+        isn't loaded at all.
+
+        :param charter_abstracts: iterable of (charter abstract, charter id) tuples
+        :param cache: the ParseCache
+        :param batch_size: number of abstracts per batch
+        :param n_process: number of worker processes (-1 uses all cores)
+        :return: generator of (spaCy doc object, charter id) tuples in input order
+        """
+        batch = []
+        for charter_abstract, charter_id in charter_abstracts:
+            batch.append((charter_abstract, charter_id))
+            if len(batch) >= batch_size:
+                for doc, charter_id in self._parse_batch(batch, cache, batch_size, n_process):
+                    yield doc, charter_id
+                batch = []
+        for doc, charter_id in self._parse_batch(batch, cache, batch_size, n_process):
+            yield doc, charter_id
+        cache.save()
+
+    def _parse_batch(self, batch, cache, batch_size, n_process):
+        docs = [cache.get(charter_abstract) for charter_abstract, _ in batch]
+        missing = [i for i, doc in enumerate(docs) if doc is None]
+        if missing:
+            parsed = self.pipe_dependency_parse([batch[i] for i in missing], batch_size, n_process)
+            for i, (doc, _) in zip(missing, parsed):
+                cache.put(batch[i][0], doc)
+                docs[i] = doc
+        return [(doc, charter_id) for doc, (_, charter_id) in zip(docs, batch)]
+
+    def merge_entities(self, doc):
+        """
+        Merge and retokenize the named entities of a doc, so that e.g. 'Ulrich von Abbach' becomes a single token
+
+        :param doc: the spaCy doc object
+        :return: the retokenized spaCy doc object
+        """
         # get named entities
         entities = [(ent.start, ent.end, ent.label, ent.lemma_)
                 for ent in doc.ents]
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+On-disk cache of parsed and retokenized charter abstracts.
+
+Parsing is by far the most expensive step of the pipeline. The cache keeps the docs returned by
+NLP.spacy_dependency_parse, keyed by a hash of the charter abstract. Each language model (name and version) gets
+its own cache directory, so a new model never returns stale parses.
+
+The docs are stored in shards serialized with spaCy's DocBin. Each shard has a small index file next to it
+(shard-NNNNNN.json) listing the abstract hashes in the order of the docs, the index files are merged when the cache
+is opened. Writing a shard never rewrites the index of the other shards. Cached docs are restored with an empty
+vocab, so NLP.analyze_dep can be run on them without loading the language model at all.
+
+See: https://spacy.io/api/docbin
+"""
+from __future__ import unicode_literals
+from spacy.tokens import DocBin
+from spacy.vocab import Vocab
+import hashlib
+import json
+import os
+import re
+
+# token attributes needed by NLP.analyze_dep and NLP.check_subject
+ATTRS = ["ORTH", "TAG", "POS", "HEAD", "DEP", "LEMMA", "ENT_IOB", "ENT_TYPE", "SPACY"]
+
+
+def abstract_hash(charter_abstract):
+    """
+    Hash a charter abstract
+
+    :param charter_abstract: the charter abstract
+    :return: the hex digest of the abstract
+    """
+    return hashlib.sha1(charter_abstract.encode('utf-8')).hexdigest()
+
+
+class ParseCache:
+
+    def __init__(self, directory, model_key, shard_size=1000):
+        """
+        :param directory: the cache directory
+        :param model_key: name and version of the language model, see NLP.model_key
+        :param shard_size: number of docs per DocBin shard
+        """
+        # the key is a single directory name inside the cache directory, never a path of its own
+        self.directory = os.path.join(directory, re.sub(r'[^\w.+-]', '_', model_key))
+        self.shard_size = shard_size
+        self.vocab = Vocab()
+        self.hits = 0
+        self.misses = 0
+        self._pending = {}
+        self._shard = (None, [])
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # abstract hash -> (shard, position)
+        self._index = {}
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith('shard-') and name.endswith('.json'):
+                with open(os.path.join(self.directory, name)) as index_file:
+                    shard = name[:-len('.json')] + '.spacy'
+                    for position, key in enumerate(json.load(index_file)):
+                        self._index[key] = (shard, position)
+
+    def __len__(self):
+        return len(self._index) + len(self._pending)
+
+    def __contains__(self, charter_abstract):
+        key = abstract_hash(charter_abstract)
+        return key in self._pending or key in self._index
+
+    def get(self, charter_abstract):
+        """
+        Return the cached doc of a charter abstract
+
+        :param charter_abstract: the charter abstract
+        :return: the spaCy doc object or None if the abstract wasn't parsed before
+        """
+        key = abstract_hash(charter_abstract)
+        if key in self._pending:
+            self.hits += 1
+            return self._pending[key]
+        if key not in self._index:
+            self.misses += 1
+            return None
+        shard, position = self._index[key]
+        # keep the last shard in memory, abstracts are usually read in the order they were cached
+        if self._shard[0] != shard:
+            with open(os.path.join(self.directory, shard), 'rb') as shard_file:
+                doc_bin = DocBin().from_bytes(shard_file.read())
+            self._shard = (shard, list(doc_bin.get_docs(self.vocab)))
+        self.hits += 1
+        return self._shard[1][position]
+
+    def put(self, charter_abstract, doc):
+        """
+        Add the doc of a charter abstract to the cache. Docs are written to disk once a shard is full.
+
+        :param charter_abstract: the charter abstract
+        :param doc: the spaCy doc object returned by NLP.spacy_dependency_parse
+        :return:
+        """
+        self._pending[abstract_hash(charter_abstract)] = doc
+        if len(self._pending) >= self.shard_size:
+            self.save()
+
+    def save(self):
+        """
+        Write pending docs to a new shard and its index
+
+        :return:
+        """
+        if not self._pending:
+            return
+        name = 'shard-{0:06d}'.format(len([shard for shard in os.listdir(self.directory)
+                                            if shard.startswith('shard-') and shard.endswith('.spacy')]))
+        keys = list(self._pending)
+        doc_bin = DocBin(attrs=ATTRS)
+        for key in keys:
+            doc_bin.add(self._pending[key])
+        with open(os.path.join(self.directory, name + '.spacy'), 'wb') as shard_file:
+            shard_file.write(doc_bin.to_bytes())
+        # the index of the shard is written last and atomically, shards without an index are ignored, so an
+        # interrupted run never leaves a broken cache behind
+        index_path = os.path.join(self.directory, name + '.json')
+        with open(index_path + '.tmp', 'w') as index_file:
+            json.dump(keys, index_file)
+        os.rename(index_path + '.tmp', index_path)
+        for position, key in enumerate(keys):
+            self._index[key] = (name + '.spacy', position)
+        self._pending = {}
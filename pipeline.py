@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Pipelined ingestion: parsing and graph writes overlap.
+
+Run one after another, the CPU is idle while neo4j writes a batch and neo4j is idle while spaCy parses. The Pipeline
+runs both at the same time:
+
+    parser processes (nlp.pipe) -> NLP.extract -> bounded queue -> writer threads (one GraphWriter each) -> neo4j
+
+The queue holds at most queue_size charters. If the writers fall behind, the parser waits until there is room in
+the queue again, so memory stays bounded. Every writer thread has its own GraphWriter and, because neomodel's
+connection is thread-local, its own session from the driver's connection pool. Before several writer threads are
+started, the graph store creates uniqueness constraints on the entity names (see Neo4jStore.ensure_constraints), so
+two writers merging the same new entity at the same time can't both create it.
+
+Errors are isolated per charter: records of the stream that can't be read are skipped, if a parser batch fails, its
+abstracts are parsed again one by one, and if a write batch fails (e.g. a transaction aborted in a deadlock of two
+writers), its charters are written again one by one. Charters that still fail are reported in Pipeline.errors and
+the run goes on.
+
+Usage:
+
+    $ python pipeline.py regesta/ more_regesta.jsonl --parser-processes 4 --writer-threads 4
+"""
+from __future__ import unicode_literals
+from collections import deque
+from examples import (aliases, config_file, graph_store)
+from graph_writer import (GraphWriter, Neo4jStore)
+from ingest import (CHARTER_FIELDS, read_sources)
+from metrics import MetricsRegistry
+from nlp import NLP
+from parse_cache import (abstract_hash, ParseCache)
+import argparse
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Pipeline:
+
+    def __init__(self, nlp, store_factory=Neo4jStore, parser_processes=1, writer_threads=2, queue_size=1000,
+                 batch_size=64, write_batch_size=500, cache=None, metrics=None):
+        """
+        :param nlp: the NLP pipeline
+        :param store_factory: function returning the graph store of a writer thread
+        :param parser_processes: number of parser processes (-1 uses all cores)
+        :param writer_threads: number of writer threads
+        :param queue_size: maximum number of parsed charters waiting for a writer
+        :param batch_size: number of abstracts per parser batch
+        :param write_batch_size: number of charters per transaction
+        :param cache: optional ParseCache
+        :param metrics: optional MetricsRegistry, the writes of the writer threads are measured
+        """
+        self.nlp = nlp
+        self.store_factory = store_factory
+        self.parser_processes = parser_processes
+        self.writer_threads = writer_threads
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.write_batch_size = write_batch_size
+        self.cache = cache
+        self.metrics = metrics
+        self.parsed = 0
+        self.written = 0
+        # list of (charter id, stage, error message) tuples
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def run(self, charter_abstracts, incremental=False):
+        """
+        Parse and write charters until the stream is exhausted
+
+        :param charter_abstracts: iterable of (charter abstract, charter record) tuples, the record is a dict with
+            'charter_id' and optional charter fields like 'file_id' or 'mom_id'
+        :param incremental: only process new and changed charters
+        :return: the number of written charters
+        """
+        pipeline_version = self.nlp.pipeline_version
+        charter_abstracts = self._read(charter_abstracts)
+        if self.writer_threads > 1:
+            ensure_constraints = getattr(self.store_factory(), 'ensure_constraints', None)
+            if ensure_constraints is not None:
+                ensure_constraints()
+        if incremental:
+            charter_abstracts = GraphWriter(self.store_factory(), self.write_batch_size).filter_changed(
+                charter_abstracts, pipeline_version, get_id=lambda record: record['charter_id'],
+                on_error=self._filter_error)
+
+        # while charters are retracted, the writers mustn't rely on entities they wrote before
+        graph_writers = [GraphWriter(self.store_factory(), batch_size=self.write_batch_size + 1,
+                                     skip_written=not incremental) for _ in range(self.writer_threads)]
+        if self.metrics is not None:
+            for graph_writer in graph_writers:
+                self.metrics.instrument(writer=graph_writer)
+            self.metrics.gauge('pipeline.queue_depth', self.queue.qsize)
+            self.metrics.gauge('pipeline.errors', lambda: len(self.errors))
+        writers = [threading.Thread(target=self._write_loop, args=(graph_writer,)) for graph_writer in graph_writers]
+        for writer in writers:
+            writer.daemon = True
+            writer.start()
+        try:
+            for doc, dep_data, record in self._extract(charter_abstracts):
+                charter_fields = dict((str(field), record[field]) for field in CHARTER_FIELDS if field in record)
+                charter_fields.update(content_hash=abstract_hash(doc.text), pipeline_version=pipeline_version)
+                # blocks while the queue is full
+                self.queue.put((record['charter_id'], dep_data, charter_fields))
+                self.parsed += 1
+        finally:
+            # one stop signal per writer thread
+            for _ in writers:
+                self.queue.put(None)
+            for writer in writers:
+                writer.join()
+        return self.written
+
+    def _read(self, charter_abstracts):
+        """
+        Pull the (charter abstract, charter record) tuples from the stream. Items that can't be read, have no
+        abstract or no charter id are reported as read errors and skipped, so they never reach the parser.
+        """
+        charter_abstracts = iter(charter_abstracts)
+        position = 0
+        while True:
+            charter_id = 'record {0}'.format(position)
+            position += 1
+            try:
+                item = next(charter_abstracts)
+                charter_abstract, record = item
+                charter_id = record['charter_id']
+                if not isinstance(charter_abstract, basestring) or not charter_abstract:
+                    raise ValueError('no abstract')
+            except StopIteration:
+                return
+            except Exception as e:
+                self._error(charter_id, 'read', e)
+                continue
+            yield item
+
+    def _extract(self, charter_abstracts):
+        """
+        Run NLP.extract on the stream. If a parser batch fails, the abstracts that were handed to the parser but not
+        returned yet are parsed again one by one, then the stream is resumed. An error of the stream itself ends it
+        and is raised once the abstracts handed to the parser are done.
+        """
+        charter_abstracts = iter(charter_abstracts)
+        pending = deque()
+        upstream = []
+
+        def track():
+            while True:
+                try:
+                    item = next(charter_abstracts)
+                except StopIteration:
+                    return
+                except Exception as e:
+                    # not the parser's fault, the parser gets an exhausted stream
+                    upstream.append(e)
+                    return
+                pending.append(item)
+                yield item
+
+        while True:
+            try:
+                for doc, dep_data, record in self.nlp.extract(track(), self.batch_size, self.parser_processes,
+                                                              self.cache):
+                    pending.popleft()
+                    yield doc, dep_data, record
+                if upstream:
+                    raise upstream[0]
+                return
+            except Exception:
+                # nothing was handed to the parser, the error isn't caused by an abstract
+                if not pending:
+                    raise
+                suspects = list(pending)
+                pending.clear()
+            for item in suspects:
+                try:
+                    results = list(self.nlp.extract([item], batch_size=1, n_process=1))
+                except Exception as e:
+                    self._error(item[1]['charter_id'], 'parse', e)
+                    continue
+                for result in results:
+                    yield result
+
+    def _write_loop(self, writer):
+        # the writer flushes only when it is told to, see _write_batch
+        batch = []
+        while True:
+            item = self.queue.get()
+            if item is not None:
+                batch.append(item)
+            if batch and (item is None or len(batch) >= self.write_batch_size):
+                self._write_batch(writer, batch)
+                batch = []
+            if item is None:
+                return
+
+    def _write_batch(self, writer, batch):
+        """
+        Write a batch of charters in one transaction. If the transaction fails, the charters are written one by one.
+        """
+        try:
+            for charter_id, dep_data, charter_fields in batch:
+                writer.add(charter_id, dep_data, **charter_fields)
+            writer.flush()
+            written = len(batch)
+        except Exception:
+            writer.clear()
+            written = 0
+            for charter_id, dep_data, charter_fields in batch:
+                try:
+                    writer.add(charter_id, dep_data, **charter_fields)
+                    writer.flush()
+                    written += 1
+                except Exception as e:
+                    writer.clear()
+                    self._error(charter_id, 'write', e)
+        with self._lock:
+            self.written += written
+
+    def _filter_error(self, charter_ids, error):
+        for charter_id in charter_ids:
+            self._error(charter_id, 'filter', error)
+
+    def _error(self, charter_id, stage, error):
+        with self._lock:
+            self.errors.append((charter_id, stage, '{0}: {1}'.format(type(error).__name__, error)))
+        print('{0} failed ({1}): {2}'.format(charter_id, stage, error))
+
+
+if __name__ == "__main__":
+    settings = config_file['pipeline']
+    parser = argparse.ArgumentParser(description='Stream regesta sources into neo4j, parsing and writing at the '
+                                                 'same time.')
+    parser.add_argument('sources', nargs='+', help='directories of urkNNNN.txt files, JSONL or CSV files')
+    parser.add_argument('--incremental', action='store_true', help='only process new and changed charters')
+    parser.add_argument('--parse-cache', action='store_true', help='use the parse cache set in config.json')
+    parser.add_argument('--parser-processes', type=int, default=settings['parser-processes'],
+                        help='number of parser processes')
+    parser.add_argument('--writer-threads', type=int, default=settings['writer-threads'],
+                        help='number of writer threads')
+    parser.add_argument('--queue-size', type=int, default=settings['queue-size'],
+                        help='maximum number of parsed charters waiting for a writer')
+    parser.add_argument('--batch-size', type=int, default=settings['batch-size'],
+                        help='number of abstracts per parser batch')
+    parser.add_argument('--write-batch-size', type=int, default=settings['write-batch-size'],
+                        help='number of charters per transaction')
+    parser.add_argument('--id-prefix', default='SpAR Urk.', help='prefix of charter ids derived from file names')
+    parser.add_argument('--metrics', metavar='FILE', help='measure the stages and save the metrics to a JSON file')
+    parser.add_argument('--report-interval', type=float, default=60, help='seconds between two metrics summaries')
+    args = parser.parse_args()
+
+    nlp = NLP(config_file['spacy']['model'], config_file['spacy']['components'], config_file['spacy']['lazy'],
+              fast_path=config_file['spacy']['fast-path'], aliases=aliases)
+    cache = ParseCache(config_file['spacy']['parse-cache'], nlp.model_key) if args.parse_cache else None
+    pipeline = Pipeline(nlp, store_factory=graph_store, parser_processes=args.parser_processes,
+                        writer_threads=args.writer_threads, queue_size=args.queue_size, batch_size=args.batch_size,
+                        write_batch_size=args.write_batch_size, cache=cache,
+                        metrics=MetricsRegistry() if args.metrics else None)
+    if pipeline.metrics is not None:
+        pipeline.metrics.instrument(nlp=nlp, parse_cache=cache)
+        pipeline.metrics.start_reporter(args.report_interval)
+    records = ((record.pop('abstract', None), record) for record in read_sources(args.sources, args.id_prefix))
+    pipeline.run(records, incremental=args.incremental)
+    print('{0} charters parsed, {1} written, {2} failed'.format(pipeline.parsed, pipeline.written,
+                                                                len(pipeline.errors)))
+    print(nlp.report())
+    if pipeline.metrics is not None:
+        pipeline.metrics.stop_reporter()
+        print(pipeline.metrics.summary())
+        pipeline.metrics.dump(args.metrics)
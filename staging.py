@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compact staging graph for the GraphWriter.
+
+The statements extracted from charter abstracts repeat a lot: the same actors, activities and places appear in
+thousands of charters, and so do many of their relationships, e.g. ('verkaufen')-[:P14_carried_out_by]->('Spital').
+The StagingGraph collects the statements of a batch before they are written:
+
+ - CRM classes, CRM properties and entity names are interned, every entity is stored once as a Node record and
+   referred to by its integer id
+ - relationships are keyed by (source id, property id, target id), so a relationship extracted from many charters is
+   written once with the ids of all of them
+ - entity nodes written in an earlier batch aren't sent to the graph store again, only their new relationships
+
+Entity ids are kept for the whole run, charter nodes only for the current batch, because every charter is written
+once.
+"""
+from __future__ import unicode_literals
+from neomodel.relationship_manager import INCOMING
+
+
+class Node(object):
+    __slots__ = ('label', 'name', 'props')
+
+    def __init__(self, label, name, props=None):
+        self.label = label
+        self.name = name
+        self.props = props
+
+
+class StagingGraph:
+
+    def __init__(self):
+        # interned crm classes and crm properties
+        self.labels = []
+        self.properties = []
+        self._label_ids = {}
+        self._property_ids = {}
+        # entity id -> Node, (label id, name) -> entity id
+        self._entities = []
+        self._entity_ids = {}
+        # entity id -> 1 if the entity was written to the graph store
+        self._written = bytearray()
+        # number of entity nodes that weren't written again
+        self.skipped = 0
+        self.clear()
+
+    def __len__(self):
+        return len(self._charters)
+
+    def clear(self):
+        """
+        Drop the charters and relationships of the current batch. Interned entities are kept.
+
+        :return:
+        """
+        # charter index -> Node, charter id -> charter index
+        self._charters = []
+        self._charter_ids = {}
+        # ids of the entities of the current batch
+        self._batch = set()
+        # (source, property id, target) -> charter indices, charters are referred to as -(charter index + 1)
+        self._relationships = {}
+
+    def add(self, charter_id, nodes, relationships, charter_fields=None):
+        """
+        Add the statements of a charter
+
+        :param charter_id: the charter id used by the archive
+        :param nodes: list of (crm class, name) nodes, the first node is the charter node
+        :param relationships: list of (source node, crm property, target node) relationships
+        :param charter_fields: attributes of the charter node
+        :return:
+        """
+        index = self._charter_ids.get(charter_id)
+        if index is None:
+            index = self._charter_ids[charter_id] = len(self._charters)
+            self._charters.append(Node(self._intern_label(nodes[0][0]), charter_id, {}))
+        self._charters[index].props.update(charter_fields or {})
+        refs = {nodes[0]: -(index + 1)}
+        for node in nodes[1:]:
+            refs[node] = self._intern_entity(node)
+            self._batch.add(refs[node])
+        for src, prop, dst in relationships:
+            key = (refs[src], self._intern_property(prop), refs[dst])
+            charters = self._relationships.get(key)
+            if charters is None:
+                self._relationships[key] = [index]
+            elif charters[-1] != index:
+                charters.append(index)
+
+    def export(self, relationship_type):
+        """
+        Return the current batch in the format of the graph stores
+
+        :param relationship_type: function returning relationship type and direction of a crm class and property,
+            see graph_writer.relationship_type
+        :return: dict of crm class -> list of {'name': ..., 'props': {...}} rows and dict of
+            (source crm class, relationship type, target crm class) -> list of
+            {'src': ..., 'dst': ..., 'charters': [...]} rows
+        """
+        nodes = {}
+        for charter in self._charters:
+            nodes.setdefault(self.labels[charter.label], []).append({'name': charter.name, 'props': charter.props})
+        for entity_id in self._batch:
+            if self._written[entity_id]:
+                self.skipped += 1
+                continue
+            entity = self._entities[entity_id]
+            nodes.setdefault(self.labels[entity.label], []).append({'name': entity.name, 'props': {}})
+        relationships = {}
+        for (src, prop, dst), charters in self._relationships.items():
+            src, dst = self._node(src), self._node(dst)
+            rel_type, direction = relationship_type(self.labels[src.label], self.properties[prop])
+            # store incoming relationships in the direction they have in the graph
+            if direction == INCOMING:
+                src, dst = dst, src
+            relationships.setdefault((self.labels[src.label], rel_type, self.labels[dst.label]), []).append(
+                {'src': src.name, 'dst': dst.name,
+                 'charters': sorted(set(self._charters[index].name for index in charters))})
+        return nodes, relationships
+
+    def mark_written(self):
+        """
+        Remember that the entities of the current batch were written to the graph store
+
+        :return:
+        """
+        for entity_id in self._batch:
+            self._written[entity_id] = 1
+
+    def forget_written(self):
+        """
+        Write all entities again, e.g. after the graph store deleted orphaned entities while retracting charters
+
+        :return:
+        """
+        self._written = bytearray(len(self._written))
+
+    def _node(self, ref):
+        return self._charters[-ref - 1] if ref < 0 else self._entities[ref]
+
+    def _intern_label(self, label):
+        label_id = self._label_ids.get(label)
+        if label_id is None:
+            label_id = self._label_ids[label] = len(self.labels)
+            self.labels.append(label)
+        return label_id
+
+    def _intern_property(self, prop):
+        property_id = self._property_ids.get(prop)
+        if property_id is None:
+            property_id = self._property_ids[prop] = len(self.properties)
+            self.properties.append(prop)
+        return property_id
+
+    def _intern_entity(self, node):
+        key = (self._intern_label(node[0]), node[1])
+        entity_id = self._entity_ids.get(key)
+        if entity_id is None:
+            entity_id = self._entity_ids[key] = len(self._entities)
+            self._entities.append(Node(key[0], node[1]))
+            self._written.append(0)
+        return entity_id
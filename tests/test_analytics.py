@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The incrementally updated matrices of CoParticipation equal the dense products A . A^T and A^T . A of the charters'
+actors, after charters were added, replaced, read from the graph or deleted from it and after a save and load. The
+graph is a dict behind a stand-in for neomodel's db.
+"""
+from __future__ import unicode_literals
+from analytics import CoParticipation
+import analytics
+import numpy
+import random
+import shutil
+import tempfile
+import unittest
+
+
+class FakeDB:
+    """
+    Answers the two queries of CoParticipation.load_graph from a dict charter id -> [node id, content hash, pipeline
+    version, actors]
+    """
+
+    def __init__(self):
+        self.charters = {}
+        self._node_id = 0
+
+    def put(self, charter_id, content_hash, actors):
+        if charter_id not in self.charters:
+            self._node_id += 1
+            self.charters[charter_id] = [self._node_id, None, None, []]
+        self.charters[charter_id][1:] = [content_hash, '1', list(actors)]
+
+    def cypher_query(self, query, params):
+        if 'RETURN id(c)' in query:
+            rows = sorted([node_id, charter_id, content_hash, pipeline_version] for
+                          charter_id, (node_id, content_hash, pipeline_version, _) in self.charters.items()
+                          if node_id > params['after'])
+            return rows[:params['limit']], None
+        return [[charter_id, self.charters[charter_id][3]] for charter_id in params['ids']
+                if charter_id in self.charters], None
+
+
+class CoParticipationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = analytics.db
+        analytics.db = FakeDB()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        analytics.db = self.db
+        shutil.rmtree(self.directory)
+
+    def assertMatrices(self, co_participation, actors):
+        """
+        Compare the matrices with the dense products of the incidence matrix of actors
+
+        :param co_participation: the CoParticipation
+        :param actors: dict charter id -> actor names, charters which are missing have no actors
+        """
+        dense = numpy.zeros((len(co_participation.charters), len(co_participation.actors)), dtype=numpy.int32)
+        for charter_id, names in actors.items():
+            for actor in names:
+                dense[co_participation.charters.index(charter_id), co_participation.actors.index(actor)] = 1
+        numpy.testing.assert_array_equal(co_participation.incidence.toarray(), dense)
+        numpy.testing.assert_array_equal(co_participation.charter_cooccurrence().toarray(), dense.dot(dense.T))
+        numpy.testing.assert_array_equal(co_participation.actor_cooccurrence().toarray(), dense.T.dot(dense))
+
+    def test_add(self):
+        rng = random.Random(1483)
+        co_participation = CoParticipation()
+        actors = {}
+        for _ in range(40):
+            # new and replaced charters, some without actors, a few changes per update
+            for _ in range(rng.randint(1, 6)):
+                charter_id = 'SpAR Urk. {0}'.format(rng.randint(1, 30))
+                actors[charter_id] = set('actor {0}'.format(rng.randint(1, 15)) for _ in range(rng.randint(0, 4)))
+                co_participation.add(charter_id, actors[charter_id])
+            self.assertMatrices(co_participation, actors)
+        co_participation.save(self.directory)
+        self.assertMatrices(CoParticipation.load(self.directory), actors)
+
+    def test_load_graph(self):
+        graph = analytics.db
+        for i in range(20):
+            graph.put('SpAR Urk. {0}'.format(i), 'hash {0}'.format(i), ['actor {0}'.format(i % 5), 'Spital'])
+        co_participation = CoParticipation()
+        self.assertEqual(co_participation.load_graph(batch_size=7), 20)
+        self.assertMatrices(co_participation, dict((charter_id, charter[3]) for charter_id, charter in
+                                                   graph.charters.items()))
+        co_participation.save(self.directory)
+        co_participation = CoParticipation.load(self.directory)
+        # only the re-ingested, retracted, new and deleted charters are read again
+        graph.put('SpAR Urk. 3', 'new hash', ['Otto'])
+        graph.charters['SpAR Urk. 4'][1:] = [None, None, []]
+        del graph.charters['SpAR Urk. 5']
+        graph.put('SpAR Urk. 30', 'hash 30', ['actor 1'])
+        self.assertEqual(co_participation.load_graph(batch_size=7), 3)
+        self.assertMatrices(co_participation, dict((charter_id, charter[3]) for charter_id, charter in
+                                                   graph.charters.items()))
+        self.assertNotIn('SpAR Urk. 5', co_participation.versions)
+        self.assertEqual(co_participation.load_graph(batch_size=7), 0)
+
+    def test_save(self):
+        co_participation = CoParticipation()
+        co_participation.add('SpAR Urk. 1', ['Otto', 'Spital'], ('hash 1', '1'))
+        co_participation.add('SpAR Urk. 2', ['Ulrich', 'Spital'], ('hash 2', '1'))
+        # only the incidence matrix was computed, the co-occurrence matrices aren't saved
+        co_participation.save(self.directory)
+        loaded = CoParticipation.load(self.directory)
+        self.assertEqual((loaded.charters, loaded.actors), (co_participation.charters, co_participation.actors))
+        self.assertEqual(loaded.versions, {'SpAR Urk. 1': ('hash 1', '1'), 'SpAR Urk. 2': ('hash 2', '1')})
+        self.assertIsNone(loaded._charter_cooccurrence)
+        self.assertEqual(loaded.charter_neighbours('SpAR Urk. 1'), [('SpAR Urk. 2', 1)])
+        # the co-occurrence matrices computed since are saved, and the saved matrices are updated after a load
+        loaded.add('SpAR Urk. 3', ['Otto'])
+        loaded.charter_cooccurrence()
+        loaded.actor_cooccurrence()
+        loaded.save(self.directory)
+        loaded = CoParticipation.load(self.directory)
+        self.assertIsNotNone(loaded._charter_cooccurrence)
+        self.assertEqual(loaded.actor_neighbours('Otto'), [('Spital', 1)])
+        loaded.add('SpAR Urk. 1', ['Otto'])
+        self.assertEqual(loaded.actor_neighbours('Otto'), [])
+        self.assertMatrices(loaded, {'SpAR Urk. 1': ['Otto'], 'SpAR Urk. 2': ['Ulrich', 'Spital'],
+                                     'SpAR Urk. 3': ['Otto']})
+        # nothing saved yet
+        self.assertEqual(CoParticipation.load(tempfile.mkdtemp(dir=self.directory)).charters, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The CSVExportStore writes every node and every relationship once, with the charter ids of all batches it was
+extracted in, and in a format the importer reads back unchanged.
+"""
+from __future__ import unicode_literals
+from bulk_export import (CSVExportStore, node_id)
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+
+def batch(charter_id, actor):
+    nodes = {"E5Event": [{'name': charter_id, 'props': {'file_id': 'urk.txt'}}],
+             "E21Person": [{'name': actor, 'props': {}}]}
+    relationships = {("E5Event", 'P11_HAD_PARTICIPANT', "E21Person"): [
+        {'src': charter_id, 'dst': actor, 'charters': [charter_id]}]}
+    return nodes, relationships
+
+
+class CSVExportStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = CSVExportStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name)) as export_file:
+            return list(csv.reader(export_file))
+
+    def test_merge(self):
+        relationships = {("E7Activity", 'P14_CARRIED_OUT_BY', "E21Person"): [
+            {'src': 'verkaufen', 'dst': 'Otto', 'charters': ['SpAR Urk. 2']}]}
+        self.store.write({"E21Person": [{'name': 'Otto', 'props': {}}]}, relationships)
+        self.store.write({"E21Person": [{'name': 'Otto', 'props': {}}, {'name': 'Ulrich', 'props': {}}]}, {
+            ("E7Activity", 'P14_CARRIED_OUT_BY', "E21Person"): [
+                {'src': 'verkaufen', 'dst': 'Otto', 'charters': ['SpAR Urk. 1', 'SpAR Urk. 2']},
+                {'src': 'verkaufen', 'dst': 'Ulrich', 'charters': ['SpAR Urk. 3']}]})
+        self.store.close()
+        self.assertEqual((self.store.nodes_written, self.store.relationships_written), (2, 2))
+        rows = self.read('relationships_P14_CARRIED_OUT_BY.csv')
+        self.assertEqual(rows[0], [':START_ID', ':END_ID', ':TYPE', 'charters:string[]'])
+        activity = node_id("E7Activity", 'verkaufen')
+        self.assertEqual(sorted(rows[1:]), sorted([
+            [activity, node_id("E21Person", 'Otto'), 'P14_CARRIED_OUT_BY', 'SpAR Urk. 1;SpAR Urk. 2'],
+            [activity, node_id("E21Person", 'Ulrich'), 'P14_CARRIED_OUT_BY', 'SpAR Urk. 3']]))
+        self.assertEqual(sorted(name for name in os.listdir(self.directory)),
+                         ['nodes_E21Person.csv', 'relationships_P14_CARRIED_OUT_BY.csv'])
+
+    def test_quoting(self):
+        name = 'Hainreich, genannt "der Mulnar"\nvon Chesching'
+        self.store.write(*batch('SpAR Urk. 1', name))
+        self.store.close()
+        rows = self.read('nodes_E21Person.csv')
+        column = rows[0].index('name')
+        self.assertEqual([row[column] for row in rows[1:]], [name])
+        self.assertIn('--multiline-fields=true', self.store.import_command())
+
+    def test_array_delimiter(self):
+        self.store.write(*batch('SpAR Urk. 1', 'Otto'))
+        self.assertRaises(ValueError, self.store.write, *batch('SpAR Urk. 2;3', 'Ulrich'))
+        self.store.close()
+        self.assertEqual((self.store.nodes_written, self.store.relationships_written), (2, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The EntityCache evicts the least recently used nodes, loads a missing node only once however many threads ask for it
+at the same time and never keeps a node that was invalidated while it was loaded. The nodes are plain objects, no
+neo4j is needed.
+"""
+from __future__ import unicode_literals
+from entity_cache import EntityCache
+import threading
+import unittest
+
+
+class Loader:
+    """
+    Load function counting its calls, optionally blocked until it is released
+    """
+
+    def __init__(self, blocked=False):
+        self.calls = 0
+        self.started = threading.Event()
+        self.released = threading.Event()
+        if not blocked:
+            self.released.set()
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+            entity = object()
+        self.started.set()
+        self.released.wait(5)
+        return entity
+
+
+class EntityCacheTest(unittest.TestCase):
+
+    def test_lru(self):
+        cache = EntityCache(maxsize=2)
+        spital, otto, ulrich = (("E21Person", name) for name in ('St. Katharinenspital', 'Otto', 'Ulrich'))
+        cache.put(spital, 'spital')
+        cache.put(otto, 'otto')
+        # the use of the Spital makes Otto the least recently used node
+        self.assertEqual(cache.get(spital, Loader()), 'spital')
+        cache.put(ulrich, 'ulrich')
+        self.assertEqual(len(cache), 2)
+        loader = Loader()
+        self.assertEqual(cache.get(spital, loader), 'spital')
+        self.assertEqual(cache.get(ulrich, loader), 'ulrich')
+        self.assertEqual(loader.calls, 0)
+        cache.get(otto, loader)
+        self.assertEqual(loader.calls, 1)
+
+    def test_single_flight(self):
+        cache = EntityCache()
+        key = ("E21Person", 'St. Katharinenspital')
+        loader = Loader(blocked=True)
+        results = []
+
+        def get():
+            results.append(cache.get(key, loader))
+
+        threads = [threading.Thread(target=get) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(loader.started.wait(5))
+        loader.released.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(loader.calls, 1)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(entity is results[0] for entity in results))
+        self.assertEqual((cache.hits + cache.misses, cache.misses), (8, 1))
+        # the hot entity is never fetched again
+        self.assertIs(cache.get(key, loader), results[0])
+        self.assertEqual(loader.calls, 1)
+
+    def test_invalidate_while_loading(self):
+        cache = EntityCache()
+        key = ("E53Place", 'Regensburg')
+        loader = Loader(blocked=True)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(cache.get(key, loader)))
+        thread.start()
+        self.assertTrue(loader.started.wait(5))
+        # e.g. the charters of the node are retracted while it is loaded
+        cache.invalidate()
+        loader.released.set()
+        thread.join()
+        self.assertEqual(len(results), 1)
+        self.assertEqual(len(cache), 0)
+        self.assertIsNot(cache.get(key, Loader()), results[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
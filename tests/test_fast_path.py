@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The fast path has to extract the same quadruples from template-shaped abstracts as analyze_dep from their parses. The
+parses are built by hand the way the German model parses the templates, with merged named entities.
+
+The hand-built parses only show that the fast path agrees with them. Whether the German model really parses the
+templates that way is checked by test_model, which compares extract with and without the fast path and is skipped
+if the model isn't installed.
+"""
+from __future__ import unicode_literals
+from aliases import AliasIndex
+from nlp import NLP
+from spacy.vocab import Vocab
+from tests.test_relation_extractor import make_doc
+import json
+import os
+import shutil
+import spacy
+import tempfile
+import unittest
+
+# the German model, test_model is skipped without it
+MODEL = 'de_core_news_sm'
+
+# abstract, parsed tokens (text, dependency label, head, tag, lemma)
+ABSTRACTS = [
+    ("Ulrich von Abbach verkauft dem Spital sein Gut in Teingen um 15 Pfennig.",
+     [('Ulrich von Abbach', 'sb', 1, 'PROPN', 'Ulrich von Abbach'), ('verkauft', 'ROOT', 1, 'VERB', 'verkaufen'),
+      ('dem', 'nk', 3, 'DET', 'der'), ('Spital', 'da', 1, 'NOUN', 'Spital'), ('sein', 'nk', 5, 'DET', 'sein'),
+      ('Gut', 'oa', 1, 'NOUN', 'Gut'), ('in', 'mnr', 5, 'ADP', 'in'), ('Teingen', 'nk', 6, 'PROPN', 'Teingen'),
+      ('um', 'mnr', 5, 'ADP', 'um'), ('15', 'nk', 10, 'NUM', '15'), ('Pfennig', 'nk', 8, 'NOUN', 'Pfennig'),
+      ('.', 'punct', 1, 'PUNCT', '.')]),
+    ("Rudger vermacht dem St. Katharinenspital zwei Äcker zu Chesching.",
+     [('Rudger', 'sb', 1, 'PROPN', 'Rudger'), ('vermacht', 'ROOT', 1, 'VERB', 'vermachen'),
+      ('dem', 'nk', 3, 'DET', 'der'), ('St. Katharinenspital', 'da', 1, 'PROPN', 'St. Katharinenspital'),
+      ('zwei', 'nk', 5, 'NUM', 'zwei'), ('Äcker', 'oa', 1, 'NOUN', 'Acker'), ('zu', 'mnr', 5, 'ADP', 'zu'),
+      ('Chesching', 'nk', 6, 'PROPN', 'Chesching'), ('.', 'punct', 1, 'PUNCT', '.')]),
+    ("Otto verstiftet dem Spital den Hof in der Stadt Regensburg.",
+     [('Otto', 'sb', 1, 'PROPN', 'Otto'), ('verstiftet', 'ROOT', 1, 'VERB', 'verstiftet'),
+      ('dem', 'nk', 3, 'DET', 'der'), ('Spital', 'da', 1, 'NOUN', 'Spital'), ('den', 'nk', 5, 'DET', 'der'),
+      ('Hof', 'oa', 1, 'NOUN', 'Hof'), ('in', 'mnr', 5, 'ADP', 'in'), ('der', 'nk', 8, 'DET', 'der'),
+      ('Stadt', 'nk', 6, 'NOUN', 'Stadt'), ('Regensburg', 'nk', 8, 'PROPN', 'Regensburg'),
+      ('.', 'punct', 1, 'PUNCT', '.')]),
+    ("Konrad schenkt dem Katharinenspital das Recht auf Fischerei.",
+     [('Konrad', 'sb', 1, 'PROPN', 'Konrad'), ('schenkt', 'ROOT', 1, 'VERB', 'schenken'),
+      ('dem', 'nk', 3, 'DET', 'der'), ('Katharinenspital', 'da', 1, 'PROPN', 'Katharinenspital'),
+      ('das', 'nk', 5, 'DET', 'der'), ('Recht', 'oa', 1, 'NOUN', 'Recht'), ('auf', 'mnr', 5, 'ADP', 'auf'),
+      ('Fischerei', 'nk', 6, 'NOUN', 'Fischerei'), ('.', 'punct', 1, 'PUNCT', '.')]),
+    ("Heinrich verkauft dem Spital sein Recht um 60 Pfennige.",
+     [('Heinrich', 'sb', 1, 'PROPN', 'Heinrich'), ('verkauft', 'ROOT', 1, 'VERB', 'verkaufen'),
+      ('dem', 'nk', 3, 'DET', 'der'), ('Spital', 'da', 1, 'NOUN', 'Spital'), ('sein', 'nk', 5, 'DET', 'sein'),
+      ('Recht', 'oa', 1, 'NOUN', 'Recht'), ('um', 'mnr', 5, 'ADP', 'um'), ('60', 'nk', 8, 'NUM', '60'),
+      ('Pfennige', 'nk', 6, 'NOUN', 'Pfennig'), ('.', 'punct', 1, 'PUNCT', '.')]),
+]
+
+
+class FastPathTest(unittest.TestCase):
+
+    def setUp(self):
+        aliases = AliasIndex(threshold=1.0)
+        aliases.add('St. Katharinenspital', ['Spital', 'St.-Katharinenspital', 'Katharinenspital'], 'E21Person')
+        aliases.add('Kösching', ['Chesching'], 'E53Place')
+        # the language model isn't loaded, the parses are built by hand
+        self.nlp = NLP(MODEL, lazy=True, aliases=aliases, fast_path=True)
+        self.vocab = Vocab()
+
+    def test_same_dep_data(self):
+        for abstract, tokens in ABSTRACTS:
+            words, deps, heads, pos, lemmas = [list(column) for column in zip(*tokens)]
+            parsed = make_doc(self.vocab, words, heads, deps, pos, lemmas)
+            doc, matched = self.nlp.fast_path.match(abstract)
+            self.assertTrue(matched, abstract)
+            self.assertEqual(doc.text, abstract)
+            self.assertEqual(self.nlp.analyze_dep(doc), self.nlp.analyze_dep(parsed), abstract)
+
+    @unittest.skipUnless(spacy.util.is_package(MODEL), 'the language model {0} is not installed'.format(MODEL))
+    def test_model(self):
+        charter_abstracts = [(abstract.encode('utf-8'), i) for i, (abstract, _) in enumerate(ABSTRACTS)]
+        parsed = NLP(MODEL, aliases=self.nlp.aliases)
+        expected = [dep_data for _, dep_data, _ in parsed.extract(charter_abstracts)]
+        extracted = [dep_data for _, dep_data, _ in self.nlp.extract(charter_abstracts)]
+        self.assertEqual(self.nlp.fast_path.hits, len(ABSTRACTS))
+        self.assertEqual(extracted, expected)
+
+    def test_no_template(self):
+        doc, matched = self.nlp.fast_path.match("Dompropst Heinrich bestätigt die Testamentsverfügungen der Witwe.")
+        self.assertFalse(matched)
+
+    def test_pipeline_version(self):
+        # a model directory with nothing but its meta data, the model isn't loaded
+        model = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(model, 'meta.json'), 'w') as meta_file:
+                json.dump({'lang': 'de', 'name': 'test', 'version': '1.0.0'}, meta_file)
+            versions = [NLP(model, lazy=True, aliases=self.nlp.aliases, fast_path=fast_path).pipeline_version
+                        for fast_path in (False, True)]
+        finally:
+            shutil.rmtree(model)
+        self.assertNotEqual(versions[0], versions[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The GraphWriter writes batches to the in-memory graph store and, in incremental runs, skips unchanged charters and
+retracts the statements of changed ones.
+"""
+from __future__ import unicode_literals
+from graph_writer import (GraphWriter, relationship_type)
+from local_graph import MemoryStore
+from neomodel.relationship_manager import INCOMING
+from parse_cache import abstract_hash
+import unittest
+
+ABSTRACTS = [
+    ('Otto verkauft dem Spital sein Gut.', 'SpAR Urk. 1', ('Otto', 'verkaufen', 'St. Katharinenspital', 'Gut')),
+    ('Ulrich verkauft dem Spital sein Gut.', 'SpAR Urk. 2', ('Ulrich', 'verkaufen', 'St. Katharinenspital', 'Gut')),
+    ('Konrad schenkt dem Spital das Recht.', 'SpAR Urk. 3',
+     ('Konrad', 'schenken', 'St. Katharinenspital', ('E30Right', 'Recht'))),
+]
+
+
+def relationship(src, prop, dst):
+    """
+    Return the key of a relationship in the MemoryStore
+
+    :param src: (crm class, name) of the source node
+    :param prop: the crm property
+    :param dst: (crm class, name) of the target node
+    :return: (source node, relationship type, target node) in the direction of the graph
+    """
+    rel_type, direction = relationship_type(src[0], prop)
+    return (dst, rel_type, src) if direction == INCOMING else (src, rel_type, dst)
+
+
+class GraphWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryStore()
+        self.write(ABSTRACTS)
+
+    def write(self, abstracts, writer=None):
+        with writer or GraphWriter(self.store, batch_size=2) as writer:
+            for charter_abstract, charter_id, dep_data in abstracts:
+                writer.add(charter_id, dep_data, content_hash=abstract_hash(charter_abstract), pipeline_version='1')
+        return writer
+
+    def test_batches(self):
+        writer = GraphWriter(self.store, batch_size=2)
+        writer.add('SpAR Urk. 4', ('Otto', 'schenken'))
+        self.assertEqual(writer.written, 0)
+        writer.add('SpAR Urk. 5', ('Otto', 'schenken'))
+        self.assertEqual(writer.written, 2)
+        self.assertIn(("E5Event", 'SpAR Urk. 5'), self.store.nodes)
+        self.assertEqual(self.store.relationships[relationship(("E7Activity", 'schenken'), 'P14_carried_out_by',
+                                                               ("E21Person", 'Otto'))],
+                         set(['SpAR Urk. 4', 'SpAR Urk. 5']))
+
+    def test_filter_changed(self):
+        writer = GraphWriter(self.store, batch_size=2)
+        changed = [('Otto verkauft dem Spital sein Gut.', 'SpAR Urk. 1'),
+                   ('Ulrich vermacht dem Spital sein Gut.', 'SpAR Urk. 2'),
+                   ('Bruno verkauft dem Spital einen Grund.', 'SpAR Urk. 4')]
+        self.assertEqual([charter_id for _, charter_id in writer.filter_changed(changed, '1')],
+                         ['SpAR Urk. 2', 'SpAR Urk. 4'])
+        self.assertEqual(writer.skipped, 1)
+        # Ulrich only took part in the retracted charter, the Spital, 'verkaufen' and the Gut still have other
+        # charters
+        self.assertNotIn(("E21Person", 'Ulrich'), self.store.nodes)
+        for node in (("E21Person", 'St. Katharinenspital'), ("E7Activity", 'verkaufen'), ("E53Place", 'Gut')):
+            self.assertIn(node, self.store.nodes)
+        self.assertNotIn(relationship(("E7Activity", 'verkaufen'), 'P14_carried_out_by', ("E21Person", 'Ulrich')),
+                         self.store.relationships)
+        self.assertEqual(self.store.charter_state(['SpAR Urk. 2']), {'SpAR Urk. 2': (None, None)})
+        # the pipeline version of all charters changed
+        self.assertEqual(len(list(GraphWriter(self.store).filter_changed(changed, '2'))), 3)
+
+    def test_rewrite_retracted(self):
+        writer = self.write(ABSTRACTS[:1])
+        list(writer.filter_changed([('Otto verschenkt alles.', 'SpAR Urk. 1')], '1'))
+        self.assertNotIn(("E21Person", 'Otto'), self.store.nodes)
+        # the writer wrote Otto before, after the retraction it has to write him again
+        self.write([('Otto verschenkt alles.', 'SpAR Urk. 1', ('Otto', 'verschenken'))], writer)
+        self.assertIn(("E21Person", 'Otto'), self.store.nodes)
+        self.assertIn(relationship(("E5Event", 'SpAR Urk. 1'), 'P11_had_participant', ("E21Person", 'Otto')),
+                      self.store.relationships)
+
+
+if __name__ == '__main__':
+    unittest.main()
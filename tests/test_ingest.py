@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Malformed records of a source are skipped and logged by read_sources, the records after them are still read.
+"""
+from __future__ import unicode_literals
+from ingest import read_sources
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class ReadSourcesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def source(self, name, content):
+        path = os.path.join(self.directory, name)
+        with io.open(path, 'w', encoding='utf-8') as source_file:
+            source_file.write(content)
+        return path
+
+    def test_csv(self):
+        path = self.source('regesta.csv', 'charter_id,abstract\n'
+                                          'SpAR Urk. 1,Otto verkauft dem Spital sein Gut.\n'
+                                          'SpAR Urk. 2,Ulrich verkauft, dem Spital, sein Gut.\n'
+                                          'SpAR Urk. 3,\n'
+                                          'SpAR Urk. 4,Konrad schenkt dem Spital das Recht.\n')
+        skipped = []
+        records = list(read_sources([path], skipped=skipped))
+        self.assertEqual([(record['position'], record['charter_id']) for record in records],
+                         [(0, 'SpAR Urk. 1'), (3, 'SpAR Urk. 4')])
+        self.assertEqual(skipped, [1, 2])
+
+    def test_jsonl(self):
+        path = self.source('regesta.jsonl', '{"charter_id": "SpAR Urk. 1", "abstract": "Otto verkauft."}\n'
+                                            '{"charter_id": "SpAR Urk. 2", "abstract": \n'
+                                            '["no", "record"]\n'
+                                            '{"charter_id": "SpAR Urk. 4", "abstract": "Konrad schenkt."}\n')
+        skipped = []
+        records = list(read_sources([path], skipped=skipped))
+        self.assertEqual([record['charter_id'] for record in records], ['SpAR Urk. 1', 'SpAR Urk. 4'])
+        self.assertEqual(skipped, [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
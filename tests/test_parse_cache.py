@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The parse cache of a model has to stay inside the cache directory, and models loaded with other components must not
+share a cache. The models are directories with nothing but their meta data, they are never loaded.
+"""
+from __future__ import unicode_literals
+from aliases import AliasIndex
+from nlp import NLP
+from parse_cache import ParseCache
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class ParseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.model = os.path.join(self.directory, 'models', 'de_test')
+        os.makedirs(self.model)
+        with open(os.path.join(self.model, 'meta.json'), 'w') as meta_file:
+            json.dump({'lang': 'de', 'name': 'test', 'version': '1.0.0', 'pipeline': ['tagger', 'parser', 'ner']},
+                      meta_file)
+        self.aliases = AliasIndex(threshold=1.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def nlp(self, components):
+        return NLP(self.model, components, lazy=True, aliases=self.aliases)
+
+    def test_model_directory(self):
+        cache_directory = os.path.join(self.directory, 'cache')
+        cache = ParseCache(cache_directory, self.nlp(['tagger', 'parser', 'ner']).model_key)
+        self.assertEqual(os.path.dirname(cache.directory), cache_directory)
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'models', 'de_test')), ['meta.json'])
+
+    def test_components(self):
+        keys = [self.nlp(components).model_key for components in (['tagger', 'parser', 'ner'], ['tagger', 'parser'])]
+        self.assertEqual(keys, ['de_test-1.0.0', 'de_test-1.0.0-without-ner'])
+
+
+if __name__ == '__main__':
+    unittest.main()
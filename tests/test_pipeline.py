@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A record that can't be read, checked or parsed must not end the run of the Pipeline: it is reported in Pipeline.errors
+and every other charter of the stream is still written. The abstracts are 'parsed' by splitting them into words, so no
+language model is needed.
+"""
+from __future__ import unicode_literals
+from local_graph import MemoryStore
+from pipeline import Pipeline
+import unittest
+
+
+class WordDoc:
+
+    def __init__(self, text):
+        self.text = text
+
+
+class WordNLP:
+    """
+    Stand-in for NLP.extract, the first three words of an abstract are taken as subject, verb and object
+    """
+    pipeline_version = 'test'
+
+    def extract(self, charter_abstracts, batch_size=64, n_process=1, cache=None):
+        for charter_abstract, record in charter_abstracts:
+            if 'unparsable' in charter_abstract:
+                raise ValueError('parser failed')
+            yield WordDoc(charter_abstract), tuple(charter_abstract.split()[:3]), record
+
+
+def records(count):
+    """
+    Generate the charter records of the stream
+
+    :param count: number of charters
+    :return: generator of (charter abstract, charter record) tuples
+    """
+    for i in range(count):
+        yield 'Otto{0} verkauft Spital'.format(i), {'charter_id': 'SpAR Urk. {0}'.format(i)}
+
+
+class FailingStore(MemoryStore):
+    """
+    MemoryStore whose charter_state fails for the charter ids in failing, like a lost connection to neo4j
+    """
+
+    def __init__(self, failing):
+        MemoryStore.__init__(self)
+        self.failing = failing
+
+    def charter_state(self, charter_ids):
+        if self.failing.intersection(charter_ids):
+            raise IOError('connection lost')
+        return MemoryStore.charter_state(self, charter_ids)
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryStore()
+        self.pipeline = Pipeline(WordNLP(), store_factory=lambda: self.store, writer_threads=1, batch_size=4,
+                                 write_batch_size=3)
+
+    def charters(self):
+        return sorted(name for label, name in self.store.nodes if label == 'E5Event')
+
+    def test_bad_record(self):
+        def stream():
+            for i, item in enumerate(records(20)):
+                if i == 10:
+                    # a record without charter id in the middle of the stream
+                    yield 'Ulrich verkauft Spital', {}
+                yield item
+
+        self.assertEqual(self.pipeline.run(stream()), 20)
+        self.assertEqual(self.charters(), sorted('SpAR Urk. {0}'.format(i) for i in range(20)))
+        self.assertEqual([(charter_id, stage) for charter_id, stage, _ in self.pipeline.errors],
+                         [('record 10', 'read')])
+
+    def test_bad_abstract(self):
+        def stream():
+            for i, item in enumerate(records(20)):
+                if i == 10:
+                    yield 'unparsable abstract', {'charter_id': 'SpAR Urk. 999'}
+                yield item
+
+        self.assertEqual(self.pipeline.run(stream()), 20)
+        self.assertEqual(self.charters(), sorted('SpAR Urk. {0}'.format(i) for i in range(20)))
+        self.assertEqual([(charter_id, stage) for charter_id, stage, _ in self.pipeline.errors],
+                         [('SpAR Urk. 999', 'parse')])
+
+    def test_filter_error(self):
+        self.store = FailingStore(set())
+        self.pipeline.run(records(10))
+        self.store.failing.add('SpAR Urk. 13')
+        pipeline = Pipeline(WordNLP(), store_factory=lambda: self.store, writer_threads=1, batch_size=4,
+                            write_batch_size=3)
+        # the charters are checked in chunks of three, SpAR Urk. 12 to 14 can't be checked
+        self.assertEqual(pipeline.run(records(20), incremental=True), 7)
+        self.assertEqual(self.charters(), sorted('SpAR Urk. {0}'.format(i) for i in range(20) if not 12 <= i <= 14))
+        self.assertEqual([(charter_id, stage) for charter_id, stage, _ in pipeline.errors],
+                         [('SpAR Urk. {0}'.format(i), 'filter') for i in (12, 13, 14)])
+
+    def test_stream_error(self):
+        def stream():
+            for i, item in enumerate(records(10)):
+                if i == 6:
+                    raise IOError('source lost')
+                yield item
+
+        extracted = []
+        with self.assertRaises(IOError):
+            for _, _, record in self.pipeline._extract(stream()):
+                extracted.append(record['charter_id'])
+        # the abstracts before the error are parsed, the error isn't taken for a parser failure
+        self.assertEqual(extracted, ['SpAR Urk. {0}'.format(i) for i in range(6)])
+        self.assertEqual(self.pipeline.errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
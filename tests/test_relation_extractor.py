@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The array-based RelationExtractor has to return the same results as the token-walking heuristic it replaced. Both are
+run on a fixed set of parsed docs, built with the dependency labels of the German model, so no language model is
+needed.
+"""
+from __future__ import unicode_literals
+from aliases import AliasIndex
+from nlp import NLP
+from spacy.attrs import (DEP, HEAD, LEMMA, POS)
+from spacy.tokens import Doc
+from spacy.vocab import Vocab
+import numpy
+import random
+import unittest
+
+WORDS = ['Ulrich', 'verkauft', 'dem', 'Spital', 'sein', 'Gut', 'in', 'Teingen', 'um', 'Pfennig', 'Recht', 'auf',
+         'zu', 'von', 'sich', 'Katharinenspital', 'Grund', 'Regensburg', 'der', 'Stadt', 'verstiftet', 'bei']
+DEPS = ['sb', 'oa', 'da', 'mnr', 'nk', 'ROOT', 'cj', 'mo']
+POS_TAGS = ['NOUN', 'PROPN', 'VERB', 'DET', 'ADP']
+PREPOSITIONS = ['in', 'zu', 'bei', 'auf', 'um', 'von', 'mit']
+
+
+def make_doc(vocab, words, heads, deps, pos, lemmas):
+    """
+    Build a parsed doc
+
+    :param vocab: the vocab
+    :param words: the tokens
+    :param heads: absolute index of the head of every token
+    :param deps: dependency labels
+    :param pos: coarse-grained part-of-speech tags
+    :param lemmas: lemmas
+    :return: the spaCy doc object
+    """
+    doc = Doc(vocab, words=words)
+    strings = vocab.strings
+    # heads are stored relative to the token, as unsigned 64 bit values like the string ids
+    rows = [[(head - i) % 2 ** 64, strings.add(dep), strings.add(tag), strings.add(lemma)]
+            for i, (head, dep, tag, lemma) in enumerate(zip(heads, deps, pos, lemmas))]
+    return doc.from_array([HEAD, DEP, POS, LEMMA], numpy.array(rows, dtype='uint64'))
+
+
+def random_doc(vocab, rnd):
+    length = rnd.randint(3, 14)
+    # every token is attached to a token placed before it in a random order, so the heads form a tree
+    order = list(range(length))
+    rnd.shuffle(order)
+    heads = [0] * length
+    heads[order[0]] = order[0]
+    for k in range(1, length):
+        heads[order[k]] = order[rnd.randrange(k)]
+    words = [rnd.choice(WORDS) for _ in range(length)]
+    deps = ['ROOT' if heads[i] == i else rnd.choice(DEPS) for i in range(length)]
+    pos = [rnd.choice(POS_TAGS) for _ in range(length)]
+    lemmas = [word if word == 'verstiftet' else word.lower() for word in words]
+    return make_doc(vocab, words, heads, deps, pos, lemmas)
+
+
+def skeleton_doc(vocab, rnd):
+    # 'Ulrich verkauft dem Spital sein Gut in Teingen' with random words, further modifiers of the indirect object
+    # and randomly changed labels and tags
+    words = [rnd.choice(['Ulrich', 'Spital', 'Katharinenspital', 'sich']), rnd.choice(['verkauft', 'verstiftet']),
+             'dem', rnd.choice(['Spital', 'sich', 'Ulrich']), 'sein', rnd.choice(['Gut', 'Recht', 'Grund']),
+             rnd.choice(PREPOSITIONS), rnd.choice(['Teingen', 'Regensburg', 'Stadt'])]
+    heads = [1, 1, 3, 1, 5, 1, 5, 6]
+    deps = ['sb', 'ROOT', 'nk', 'da', 'nk', 'oa', 'mnr', 'nk']
+    pos = ['PROPN', 'VERB', 'DET', 'PROPN', 'DET', 'NOUN', 'ADP', 'PROPN']
+    for _ in range(rnd.randint(0, 2)):
+        words += [rnd.choice(PREPOSITIONS), rnd.choice(['Teingen', 'Regensburg', 'Pfennig'])]
+        heads += [5, len(heads)]
+        deps += ['mnr', 'nk']
+        pos += ['ADP', rnd.choice(['NOUN', 'PROPN', 'NUM'])]
+    for i in range(len(words)):
+        if rnd.random() < 0.1:
+            deps[i] = rnd.choice(DEPS)
+        if rnd.random() < 0.1:
+            pos[i] = rnd.choice(POS_TAGS)
+    lemmas = [word if word == 'verstiftet' else word.lower() for word in words]
+    return make_doc(vocab, words, heads, deps, pos, lemmas)
+
+
+def reference_analyze_dep(nlp, doc):
+    """
+    The token-walking heuristic analyze_dep used before the RelationExtractor, with the alias lookups of the
+    current extractor
+
+    :param nlp: the NLP object, its aliases and check_subject are used
+    :param doc: spaCy doc object
+    :return: quadruple or triple
+    """
+    subject = ''
+    verb = ''
+    dobject = ''
+    dobject2 = ''
+    index = 0
+    loc_att = ['im', 'zu', 'gegenüber', 'in', 'neben', 'beim', 'bei', 'samt']
+    right_att = ['durch', 'auf', 'von', 'über', 'um']
+    for token in doc:
+        if token.dep_ == "sb" or token.dep_ == "oa" or token.dep_ == "da" or token.dep_ == "mnr":
+            if token.dep_ == "sb" and index == 0:
+                subject = nlp.aliases.resolve(token.text, "E21Person")
+            if token.dep_ == "sb" and index == 0 and token.head.pos_ == "VERB":
+                if token.head.lemma_ == "verstiftet":
+                    verb = "verstiften"
+                else:
+                    verb = token.head.lemma_
+            if index == 1 and (token.dep_ == "da" or token.dep_ == "oa") and token.head.pos_ == "VERB":
+                dobject = nlp.aliases.resolve(token.text, "E21Person")
+                if dobject == "sich":
+                    dobject = subject
+            if index == 2 and token.dep_ == "oa":
+                dobject2 = token.text
+            if token.dep_ == 'mnr' and token.head.text == dobject2:
+                tree = [child.lemma_ for child in token.children if child.pos_ == 'NOUN' or child.pos_ == 'PROPN']
+                if tree:
+                    if token.text in loc_att:
+                        dobject2 = (dobject2, tree[0])
+                    elif token.text in right_att:
+                        dobject2 = ("E30Right", dobject2)
+            index += 1
+    if isinstance(dobject2, tuple):
+        if dobject2[0] != "E30Right":
+            dobject2 = tuple(nlp.aliases.resolve(place, "E53Place") for place in dobject2)
+    else:
+        dobject2 = nlp.aliases.resolve(dobject2, "E53Place")
+    if subject != '' and verb != '' and dobject != '' and dobject2 != '':
+        return nlp.check_subject(subject, doc), verb, dobject, dobject2
+    if subject != '' and verb != '' and dobject:
+        return nlp.check_subject(subject, doc), verb, dobject
+    if subject != '' and verb != '':
+        return nlp.check_subject(subject, doc), verb
+    return ''
+
+
+class RelationExtractorTest(unittest.TestCase):
+
+    def setUp(self):
+        aliases = AliasIndex(threshold=1.0)
+        aliases.add('St. Katharinenspital', ['Spital', 'St.-Katharinenspital', 'Katharinenspital'], 'E21Person')
+        aliases.add('Teinge', ['Teingen'], 'E53Place')
+        # the language model isn't loaded, the docs are built by hand
+        self.nlp = NLP(lazy=True, aliases=aliases)
+        self.vocab = Vocab()
+
+    def test_abstract(self):
+        # Ulrich verkauft dem Spital sein Gut in Teingen
+        doc = make_doc(self.vocab,
+                       ['Ulrich', 'verkauft', 'dem', 'Spital', 'sein', 'Gut', 'in', 'Teingen'],
+                       [1, 1, 3, 1, 5, 1, 5, 6],
+                       ['sb', 'ROOT', 'nk', 'da', 'nk', 'oa', 'mnr', 'nk'],
+                       ['PROPN', 'VERB', 'DET', 'PROPN', 'DET', 'NOUN', 'ADP', 'PROPN'],
+                       ['Ulrich', 'verkaufen', 'der', 'Spital', 'sein', 'Gut', 'in', 'Teingen'])
+        expected = ('Ulrich', 'verkaufen', 'St. Katharinenspital', ('Gut', 'Teinge'))
+        self.assertEqual(reference_analyze_dep(self.nlp, doc), expected)
+        self.assertEqual(self.nlp.analyze_dep(doc), expected)
+
+    def test_random_docs(self):
+        rnd = random.Random(0)
+        docs = [random_doc(self.vocab, rnd) if i % 2 else skeleton_doc(self.vocab, rnd) for i in range(4000)]
+        expected = [reference_analyze_dep(self.nlp, doc) for doc in docs]
+        # the extractor processes batches of docs at once, the results must not depend on the batch
+        self.assertEqual(self.nlp.analyze_deps(docs), expected)
+        self.assertEqual([self.nlp.analyze_dep(doc) for doc in docs[:200]], expected[:200])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Colin Sippl.
+#
+# This file is part of charter-abstracts.
+#
+# Charter-abstracts is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Charter-abstracts is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with charter-abstracts.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The StagingGraph writes every relationship of a batch once with the ids of all its charters, stores incoming
+relationships in their graph direction and doesn't send entities written in an earlier batch again. The relationship
+types are given by the test, so the crm model isn't needed.
+"""
+from __future__ import unicode_literals
+from neomodel.relationship_manager import (INCOMING, OUTGOING)
+from staging import StagingGraph
+import unittest
+
+RELATIONSHIP_TYPES = {
+    'P11_had_participant': ('P11_HAD_PARTICIPANT', OUTGOING),
+    'P14_carried_out_by': ('P14_CARRIED_OUT_BY', OUTGOING),
+    'P161_has_spatial_projection': ('P161_HAS_SPATIAL_PROJECTION', INCOMING),
+}
+
+
+def relationship_type(label, prop):
+    return RELATIONSHIP_TYPES[prop]
+
+
+def statements(charter_id, actor, place=None):
+    charter, activity, person = ("E5Event", charter_id), ("E7Activity", 'verkaufen'), ("E21Person", actor)
+    nodes = [charter, activity, person]
+    relationships = [(charter, "P11_had_participant", person), (activity, "P14_carried_out_by", person)]
+    if place is not None:
+        nodes.append(("E53Place", place))
+        relationships.append((activity, "P161_has_spatial_projection", ("E53Place", place)))
+    return nodes, relationships
+
+
+class StagingGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.staging = StagingGraph()
+
+    def add(self, charter_id, actor, place=None, **charter_fields):
+        nodes, relationships = statements(charter_id, actor, place)
+        self.staging.add(charter_id, nodes, relationships, charter_fields)
+
+    def test_relationships(self):
+        self.add('SpAR Urk. 2', 'Otto')
+        self.add('SpAR Urk. 1', 'Otto')
+        # the same charter added twice counts once
+        self.add('SpAR Urk. 1', 'Otto', file_id='urk0001.txt')
+        self.assertEqual(len(self.staging), 2)
+        nodes, relationships = self.staging.export(relationship_type)
+        self.assertEqual(relationships[("E7Activity", 'P14_CARRIED_OUT_BY', "E21Person")],
+                         [{'src': 'verkaufen', 'dst': 'Otto', 'charters': ['SpAR Urk. 1', 'SpAR Urk. 2']}])
+        self.assertEqual(sorted(row['dst'] for row in relationships[("E5Event", 'P11_HAD_PARTICIPANT', "E21Person")]),
+                         ['Otto', 'Otto'])
+        self.assertEqual(sorted((row['name'], row['props']) for row in nodes["E5Event"]),
+                         [('SpAR Urk. 1', {'file_id': 'urk0001.txt'}), ('SpAR Urk. 2', {})])
+        self.assertEqual(nodes["E21Person"], [{'name': 'Otto', 'props': {}}])
+
+    def test_incoming(self):
+        self.add('SpAR Urk. 1', 'Otto', 'Regensburg')
+        _, relationships = self.staging.export(relationship_type)
+        self.assertEqual(relationships[("E53Place", 'P161_HAS_SPATIAL_PROJECTION', "E7Activity")],
+                         [{'src': 'Regensburg', 'dst': 'verkaufen', 'charters': ['SpAR Urk. 1']}])
+        self.assertNotIn(("E7Activity", 'P161_HAS_SPATIAL_PROJECTION', "E53Place"), relationships)
+
+    def test_written(self):
+        self.add('SpAR Urk. 1', 'Otto')
+        self.staging.export(relationship_type)
+        self.staging.mark_written()
+        self.staging.clear()
+        self.add('SpAR Urk. 2', 'Otto')
+        nodes, relationships = self.staging.export(relationship_type)
+        # the entities of the first batch aren't written again, their relationships are
+        self.assertEqual(sorted(nodes), ["E5Event"])
+        self.assertEqual(self.staging.skipped, 2)
+        self.assertEqual(len(relationships[("E7Activity", 'P14_CARRIED_OUT_BY', "E21Person")]), 1)
+        self.staging.forget_written()
+        nodes, _ = self.staging.export(relationship_type)
+        self.assertEqual(sorted(nodes), ["E21Person", "E5Event", "E7Activity"])
+
+
+if __name__ == '__main__':
+    unittest.main()